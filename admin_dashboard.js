@@ -78,7 +78,10 @@ async function updateKPIs() {
     } catch (error) {
         console.error("Error updating summary KPIs:", error);
     }
+    await updateRevenueKPI();
+}
 
+async function updateRevenueKPI() {
     // Fetch and update Today's Revenue
     try {
         const startDate = new Date(new Date().setHours(0, 0, 0, 0)).toISOString();
@@ -92,11 +95,52 @@ async function updateKPIs() {
     }
 }
 
+// Version and ETag of the map currently on screen, so refreshes only fetch what changed
+let mapState = { lotId: null, version: null, etag: null };
+
+function setSpotStatus(spotNumber, status) {
+    const el = document.querySelector(`#parkingMap .spot[data-id="${spotNumber}"]`);
+    if (!el) return;
+    el.classList.toggle('bg-danger', status === 'occupied');
+    el.classList.toggle('bg-success', status !== 'occupied');
+    el.dataset.status = status;
+    el.setAttribute('data-bs-title', `${spotNumber} • ${status}`);
+    const tooltip = bootstrap.Tooltip.getInstance(el);
+    if (tooltip) tooltip.setContent({ '.tooltip-inner': `${spotNumber} • ${status}` });
+}
+
+function updateMapSummary() {
+    const spots = document.querySelectorAll('#parkingMap .spot').length;
+    const occupied = document.querySelectorAll('#parkingMap .spot[data-status="occupied"]').length;
+    document.getElementById('mapSummary').textContent = `${occupied} occupied • ${spots - occupied} available`;
+}
+
 async function renderMap() {
     const mapEl = document.getElementById('parkingMap');
-    mapEl.innerHTML = `<div class="spinner-border text-info m-auto" role="status"></div>`;
+    const incremental = mapState.lotId === selectedLotId && mapState.version !== null;
+    if (!incremental) {
+        mapEl.innerHTML = `<div class="spinner-border text-info m-auto" role="status"></div>`;
+    }
     try {
-        const data = await fetchWithAuth(`/admin/parking-lots/${selectedLotId}/map`);
+        const headers = { 'Authorization': `Bearer ${localStorage.getItem('accessToken')}` };
+        let endpoint = `/admin/parking-lots/${selectedLotId}/map`;
+        if (incremental) {
+            endpoint += `?since_version=${mapState.version}`;
+            if (mapState.etag) headers['If-None-Match'] = mapState.etag;
+        }
+        const response = await fetch(`${API_BASE_URL}${endpoint}`, { headers });
+        if (response.status === 304) return; // Nothing changed since the last refresh
+        if (!response.ok) {
+            if (response.status === 401) window.location.href = './index.html';
+            throw new Error(`API request failed: ${response.status}`);
+        }
+        const data = await response.json();
+        mapState = { lotId: selectedLotId, version: data.version, etag: response.headers.get('ETag') };
+        if (incremental) {
+            data.spots_array.forEach(s => setSpotStatus(s.spot_number, s.status));
+            updateMapSummary();
+            return;
+        }
         mapEl.innerHTML = data.spots_array.map(s => `
                     <button class="spot ${s.status === 'occupied' ? 'bg-danger' : 'bg-success'}" 
                             data-id="${s.spot_number}" 
@@ -107,10 +151,10 @@ async function renderMap() {
                 `).join('');
         initTooltips();
         document.getElementById('lotContext').textContent = data.lot_name;
-        const occupied = data.spots_array.filter(s => s.status === 'occupied').length;
-        document.getElementById('mapSummary').textContent = `${occupied} occupied • ${data.spots_array.length - occupied} available`;
+        updateMapSummary();
     } catch (error) {
         console.error("Error rendering map:", error);
+        mapState = { lotId: null, version: null, etag: null };
         mapEl.innerHTML = '<div class="text-danger m-auto">Failed to load parking map.</div>';
     }
 }
@@ -326,18 +370,131 @@ document.addEventListener('click', (e) => {
     }
 });
 
-// --- INITIAL PAGE LOAD ---
-window.addEventListener('DOMContentLoaded', () => {
+// --- LIVE UPDATES ---
+// The server pushes spot/ticket/payment deltas as Server-Sent Events. Polling every
+// 30 seconds is only the fallback for browsers or networks where the stream fails.
+const POLL_INTERVAL_MS = 30000;
+let eventSource = null;
+let lastEventId = null;
+let pollTimer = null;
+let streamComplete = true; // false while the server runs several workers that do not share their events
+let lotCounters = {}; // lot_id -> { name, total: {size: n}, occupied: {size: n} }
+
+const debounce = (fn, ms) => {
+    let timer;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), ms);
+    };
+};
+const refreshTicketsSoon = debounce(() => { renderTable(); fetchLiveActivity(); }, 1000);
+const refreshRevenueSoon = debounce(updateRevenueKPI, 1000);
+
+function refreshAll() {
     updateKPIs();
     renderMap();
     renderTable();
     fetchLiveActivity();
-    setInterval(() => {
-        updateKPIs();
-        renderMap();
-        renderTable();
-        fetchLiveActivity();
-    }, 30000); // Refresh every 30 seconds
+}
+
+function startPolling() {
+    if (!pollTimer) pollTimer = setInterval(refreshAll, POLL_INTERVAL_MS);
+}
+
+function stopPolling() {
+    clearInterval(pollTimer);
+    pollTimer = null;
+}
+
+function renderOccupancyKPIs() {
+    let total = 0;
+    let occupied = 0;
+    Object.values(lotCounters).forEach(lot => {
+        Object.values(lot.total).forEach(n => { total += n; });
+        Object.values(lot.occupied).forEach(n => { occupied += n; });
+    });
+    document.getElementById('kpiOccupancy').textContent = `${occupied}/${total}`;
+    document.getElementById('kpiAvailable').textContent = String(total - occupied);
+    if (total > 0) {
+        document.getElementById('kpiAvailablePct').textContent = `${Math.round(((total - occupied) / total) * 100)}% free`;
+    }
+    document.getElementById('kpiLots').textContent = String(Object.keys(lotCounters).length);
+}
+
+async function loadSnapshot() {
+    const snapshot = await fetchWithAuth('/admin/events/snapshot');
+    lotCounters = snapshot.lots;
+    lastEventId = snapshot.seq;
+    streamComplete = snapshot.complete;
+    renderOccupancyKPIs();
+}
+
+function applySpotEvent(spot) {
+    const lot = lotCounters[spot.lot_id];
+    if (lot && spot.occupied !== null) {
+        lot.occupied[spot.size] = spot.occupied;
+        renderOccupancyKPIs();
+    }
+    if (spot.lot_id !== selectedLotId || mapState.lotId !== selectedLotId) return;
+    setSpotStatus(spot.spot_number, spot.status);
+    updateMapSummary();
+    // Advance the delta cursor only over an unbroken run of changes, so none can be skipped
+    if (spot.version === mapState.version + 1) {
+        mapState.version = spot.version;
+        mapState.etag = null;
+    }
+}
+
+async function resync() {
+    // We missed events the server no longer has: reload everything and resume from the new snapshot
+    if (eventSource) eventSource.close();
+    await loadSnapshot();
+    refreshAll();
+    connectLiveEvents();
+}
+
+function connectLiveEvents() {
+    const params = new URLSearchParams({ token: localStorage.getItem('accessToken') || '' });
+    if (lastEventId !== null) params.set('last_event_id', lastEventId);
+    eventSource = new EventSource(`${API_BASE_URL}/admin/events/stream?${params.toString()}`);
+
+    const track = (handler) => (e) => {
+        lastEventId = Number(e.lastEventId);
+        handler(JSON.parse(e.data));
+    };
+    eventSource.addEventListener('spot', track(applySpotEvent));
+    eventSource.addEventListener('ticket', track(() => refreshTicketsSoon()));
+    eventSource.addEventListener('payment', track(() => { refreshTicketsSoon(); refreshRevenueSoon(); }));
+    eventSource.addEventListener('resync', track(() => resync()));
+    // The stream only replaces polling when it carries every change
+    eventSource.onopen = () => streamComplete ? stopPolling() : startPolling();
+    eventSource.onerror = () => {
+        // The browser reconnects by itself (sending Last-Event-ID); poll only once it has given up
+        if (eventSource.readyState === EventSource.CLOSED) {
+            startPolling();
+            setTimeout(connectLiveEvents, POLL_INTERVAL_MS);
+        }
+    };
+}
+
+async function startLiveUpdates() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    try {
+        await loadSnapshot();
+        connectLiveEvents();
+    } catch (error) {
+        console.error("Error starting live updates, falling back to polling:", error);
+        startPolling();
+    }
+}
+
+// --- INITIAL PAGE LOAD ---
+window.addEventListener('DOMContentLoaded', () => {
+    refreshAll();
+    startLiveUpdates();
 });
 // Wait for the page to fully load
 document.addEventListener('DOMContentLoaded', function () {
@@ -14,7 +14,9 @@ const state = {
 
 const config = {
     statusResetMs: 5000,
-    numberMaxLen: 12
+    numberMaxLen: 12,
+    // Lot this gate serves, from entry_gate.html?lot=2; the server issues its tickets from that lot's database
+    lotId: Number(new URLSearchParams(window.location.search).get('lot')) || null
 };
 
 // --- DOM ELEMENTS ---
@@ -106,12 +108,17 @@ async function handleConfirm() {
     try {
         const requestBody = {
             vehicle_number: vehicleNumber.toUpperCase(),
-            vehicle_type: state.selectedVehicleType
+            vehicle_type: state.selectedVehicleType,
+            lot_id: config.lotId
         };
 
+        // Retrying the same vehicle reuses the key, so a timed-out request that did go through is not issued twice
+        if (!state.entryAttempt || state.entryAttempt.vehicleNumber !== requestBody.vehicle_number) {
+            state.entryAttempt = { vehicleNumber: requestBody.vehicle_number, key: crypto.randomUUID() };
+        }
         const ticketData = await fetch(`${API_BASE_URL}/entry/ticket`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': state.entryAttempt.key },
             body: JSON.stringify(requestBody)
         }).then(res => {
             if (!res.ok) return res.json().then(err => Promise.reject(err));
@@ -126,6 +133,7 @@ async function handleConfirm() {
             vehicleType: state.selectedVehicleType,
             qrCodeData: ticketData.qr_code_data
         };
+        state.entryAttempt = null;
         onProcessSuccess();
     } catch (error) {
         console.error("Failed to issue ticket:", error);
@@ -275,7 +275,8 @@ async function handlePayment(method) {
 
         const paymentResult = await fetch(`${API_BASE_URL}/exit/payment`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            // A ticket is paid once, so its id keys retries of the payment
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': `exit-${state.ticketDetails.ticket_id}` },
             body: JSON.stringify(requestBody)
         }).then(res => {
             if (!res.ok) return res.json().then(err => Promise.reject(err));
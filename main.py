@@ -1,18 +1,45 @@
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-
+import argparse
+import asyncio
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Dict, Any, Literal
+
+import anyio
+import anyio.to_thread
+import numpy as np
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, status, Query
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel, Field
-from sqlalchemy import create_engine, Column, Integer, String, TIMESTAMP, ForeignKey, DECIMAL, func, extract, case, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Text, TIMESTAMP, ForeignKey, DECIMAL, func, extract, case, Boolean, update, event, Index, select, insert, inspect, false, text, and_, or_, table, column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import sessionmaker, Session, relationship, contains_eager, joinedload
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -20,20 +47,283 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 
 from slowapi.errors import RateLimitExceeded
+from slowapi.middleware import SlowAPIMiddleware
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+try:
+    import redis
+except ImportError:  # Shared response cache is optional
+    redis = None
 # --- Configuration ---
 # Reads the database URL from an environment variable for deployment
 DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./parkinglot.db")
+# Lots served from the database of their own site, as JSON: [{"shard": 1, "url": "...", "lots": [2]}].
+# Shard 0 is DATABASE_URL and keeps every lot that is not listed
+DATABASE_SHARDS = json.loads(os.environ.get("DATABASE_SHARDS", "[]"))
+# Threads running the per-shard queries of admin summaries and reports in parallel
+SHARD_GATHER_WORKERS = int(os.environ.get("SHARD_GATHER_WORKERS", 16))
+# Read-only copy of DATABASE_URL for admin reports, trends, ticket lists and exports.
+# A shard's replica goes in its DATABASE_SHARDS entry as "replica_url"
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+# How far a replica may fall behind before its reads go back to the primary
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 30))
+# How often the replica lag is measured
+REPLICA_LAG_CHECK_SECONDS = float(os.environ.get("REPLICA_LAG_CHECK_SECONDS", 5))
 SECRET_KEY = "a_very_secret_key_for_jwt"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+# How arriving vehicles are assigned a spot: nearest, fill_first or spread
+SPOT_ALLOCATION_POLICY = os.environ.get("SPOT_ALLOCATION_POLICY", "nearest")
+# How many spots a gate tries to claim before giving up when other gates keep winning the race
+SPOT_CLAIM_ATTEMPTS = int(os.environ.get("SPOT_CLAIM_ATTEMPTS", 5))
+# Threads available to the synchronous endpoints (each one holds a DB session while it runs)
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", 40))
+# Connection pool (ignored for in-memory SQLite, which uses a single connection)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+# How long a SQLite writer waits for the lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+# Postgres aborts any statement running longer than this
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 15000))
+# Authenticated users are cached by token subject instead of being re-read on every request
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", 60))
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 1024))
+# Admin role checks trust the role claim signed into the token instead of looking the user up,
+# until any user is changed after the token was issued. Needs a shared RESPONSE_CACHE_BACKEND
+TRUST_TOKEN_ROLE_CLAIM = os.environ.get("TRUST_TOKEN_ROLE_CLAIM", "false").lower() == "true"
+# bcrypt runs on its own small pool so a burst of logins cannot starve the gate endpoints
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# Logins waiting for a bcrypt worker beyond this are turned away with 503
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+# How often the occupancy counters are checked against the ParkingSpot table
+OCCUPANCY_RECONCILE_SECONDS = float(os.environ.get("OCCUPANCY_RECONCILE_SECONDS", 300))
+# Live dashboard events kept for reconnecting clients, and queued per slow subscriber
+EVENT_BACKLOG_SIZE = int(os.environ.get("EVENT_BACKLOG_SIZE", 1000))
+EVENT_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("EVENT_SUBSCRIBER_QUEUE_SIZE", 500))
+EVENT_KEEPALIVE_SECONDS = float(os.environ.get("EVENT_KEEPALIVE_SECONDS", 15))
+# How often each worker picks up the events other workers published through a shared RESPONSE_CACHE_BACKEND
+EVENT_POLL_SECONDS = float(os.environ.get("EVENT_POLL_SECONDS", 0.25))
+# Worker processes serving the app; `serve --workers` sets it for the workers it starts
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Gate responses replayed for a retried Idempotency-Key: how long they are kept, and how many per worker in memory
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+# Parking tariffs; the file is re-read when it changes, checked at most every TARIFF_RELOAD_SECONDS
+TARIFF_CONFIG = os.environ.get("TARIFF_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tariffs.json"))
+TARIFF_RELOAD_SECONDS = float(os.environ.get("TARIFF_RELOAD_SECONDS", 5))
+# Hot admin endpoints send the dicts they build straight to orjson instead of re-validating them
+# against their response_model; turn off to have every response checked again
+TRUSTED_FAST_RESPONSES = os.environ.get("TRUSTED_FAST_RESPONSES", "true").lower() == "true"
+# Rows fetched (and held in memory) at a time by the ticket export
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 2000))
+# Longest range the occupancy report accepts: its sweep reads every ticket stay overlapping the range
+OCCUPANCY_SWEEP_MAX_DAYS = int(os.environ.get("OCCUPANCY_SWEEP_MAX_DAYS", 31))
+# Cache of read-heavy admin responses, also used to invalidate cached principals across workers:
+# "local" keeps one per worker (a write only invalidates the worker that handled it, the others
+# catch up within the TTL), "sqlite" shares one through the file at RESPONSE_CACHE_PATH between
+# the workers of one host, "redis" through any Redis-compatible server at RESPONSE_CACHE_URL
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "local")
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "./response_cache.db")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 512))
+# Seconds cached responses are served for; ticket and payment writes invalidate them sooner
+REPORT_CACHE_TTL_SECONDS = float(os.environ.get("REPORT_CACHE_TTL_SECONDS", 300))
+TRENDS_HISTORY_CACHE_TTL_SECONDS = float(os.environ.get("TRENDS_HISTORY_CACHE_TTL_SECONDS", 3600))
+# Browsers may reuse GET /entry/config for this long before revalidating it by ETag
+ENTRY_CONFIG_MAX_AGE_SECONDS = int(os.environ.get("ENTRY_CONFIG_MAX_AGE_SECONDS", 300))
+# Where slowapi keeps its counters. memory:// is per worker, so with N workers every limit is N times
+# looser; point all workers at one store instead (redis://localhost:6379, memcached://localhost:11211)
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+# Limit applied to every route per client address, e.g. "600/minute"; empty means none
+RATE_LIMIT_DEFAULT = os.environ.get("RATE_LIMIT_DEFAULT", "")
+# Per-route latency, query count and DB time histograms served at GET /metrics (per worker)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# Statements slower than this are printed with the route that ran them; 0 turns the log off
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
 
 # --- Database Setup ---
-engine = create_engine(DATABASE_URL)
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe in WAL mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def create_db_engine(database_url: str):
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    connect_args = {}
+    if not (backend == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    if backend == "sqlite":
+        connect_args["timeout"] = SQLITE_BUSY_TIMEOUT_MS / 1000
+    elif backend == "postgresql":
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    db_engine = create_engine(database_url, connect_args=connect_args, **options)
+    if backend == "sqlite":
+        event.listen(db_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
+
+class PoolWaitStats:
+    """Time spent by requests waiting for a pooled connection."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+# --- Request Metrics ---
+class RequestTimings:
+    """What one request spent, filled in by the SQL hooks and timed_stage() as it runs."""
+    def __init__(self, route: str):
+        self.route = route  # The raw path until routing has matched a template
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.stages: Dict[str, float] = {}
+
+    def add_stage(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+# Set by the timing middleware; threadpool endpoints and dependencies see the same object
+current_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_request_timings", default=None)
+
+@contextmanager
+def timed_stage(name: str):
+    timings = current_request_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_stage(name, time.perf_counter() - started)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+    """A labelled Prometheus histogram, rendered in the text exposition format."""
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series: Dict[tuple, list] = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, label_values: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(labels, list(series)) for labels, series in sorted(self._series.items())]
+        for label_values, series in series_items:
+            labels = ",".join(
+                f'{name}="{escape_label_value(value)}"' for name, value in zip(self.label_names, label_values)
+            )
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time until the response headers were ready.",
+    ("method", "route", "status"), LATENCY_BUCKETS
+)
+request_db_seconds = Histogram(
+    "http_request_db_seconds", "Time spent executing SQL statements per request.", ("route",), LATENCY_BUCKETS
+)
+request_queries = Histogram(
+    "http_request_db_queries", "SQL statements executed per request.", ("route",), (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+)
+request_stage_seconds = Histogram(
+    "http_request_stage_seconds", "Time spent in a named stage of a request (stages may overlap the DB time).",
+    ("route", "stage"), LATENCY_BUCKETS
+)
+REQUEST_HISTOGRAMS = (request_seconds, request_db_seconds, request_queries, request_stage_seconds)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    timings = current_request_timings.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.db_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        # Parameters are left out: they carry plates and credentials
+        route = timings.route if timings is not None else "background"
+        print(f"--- Slow query ({elapsed * 1000:.1f} ms) in {route}: {' '.join(statement.split())[:500]} ---")
+
+@event.listens_for(Engine, "handle_error")
+def _discard_failed_query_start(context):
+    # A failed statement never reaches after_cursor_execute; drop its start time so it is not left
+    # on the pooled connection to be taken for the start of a later statement
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if context.execution_context is not None and started:
+        started.pop()
+
+@event.listens_for(Session, "before_commit")
+def _start_commit_timer(session):
+    session.info["commit_started"] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def _record_commit_time(session):
+    started = session.info.pop("commit_started", None)
+    timings = current_request_timings.get()
+    if started is not None and timings is not None:
+        # Includes the final flush, whose statements are also counted as DB time
+        timings.add_stage("commit", time.perf_counter() - started)
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in REQUEST_HISTOGRAMS:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
+
+engine = create_db_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # --- Password Hashing ---
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL while hashing, so threads give real parallelism here
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 # --- FastAPI App Initialization ---
@@ -41,16 +331,24 @@ app = FastAPI(
     title="Parking Lot Management API",
     description="API for a comprehensive parking lot management system.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    default_limits=[RATE_LIMIT_DEFAULT] if RATE_LIMIT_DEFAULT else [],
 )
-limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+if RATE_LIMIT_DEFAULT:
+    app.add_middleware(SlowAPIMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"], # Allows all methods
     allow_headers=["*"], # Allows all headers
+    expose_headers=["ETag", "X-Next-Cursor"], # Conditional requests and ticket pagination
 )
 @app.middleware("http")
 async def add_no_cache_header(request: Request, call_next):
@@ -60,6 +358,37 @@ async def add_no_cache_header(request: Request, call_next):
         response.headers["Cache-Control"] = "no-store"
     return response
 
+@app.middleware("http")
+async def record_request_timings(request: Request, call_next):
+    timings = RequestTimings(request.url.path)
+    token = current_request_timings.set(timings)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_request_timings.reset(token)
+    elapsed = time.perf_counter() - started
+    # The route template rather than the raw path, so /tickets/12 and /tickets/13 share a series
+    route = request.scope.get("route")
+    timings.route = getattr(route, "path", "unmatched")
+    if METRICS_ENABLED:
+        request_seconds.observe((request.method, timings.route, str(response.status_code)), elapsed)
+        request_db_seconds.observe((timings.route,), timings.db_seconds)
+        request_queries.observe((timings.route,), timings.queries)
+        for stage, seconds in timings.stages.items():
+            request_stage_seconds.observe((timings.route, stage), seconds)
+    response.headers["Server-Timing"] = ", ".join(
+        [f"total;dur={elapsed * 1000:.1f}", f"db;dur={timings.db_seconds * 1000:.1f};desc=\"{timings.queries} queries\""]
+        + [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.stages.items()]
+    )
+    return response
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled.")
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.api_route("/", methods=["GET", "HEAD"])
 def read_root():
     return {"status": "ok", "message": "Parking Management API is running."}
@@ -77,17 +406,24 @@ class ParkingLot(Base):
     __tablename__ = "ParkingLot"
     lot_id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False, unique=True)
+    # Bumped on every spot status change in the lot, so the lot map can be fetched as a delta
+    map_version = Column(Integer, nullable=False, default=0, server_default=text("0"))
     spots = relationship("ParkingSpot", back_populates="lot")
 
 class ParkingSpot(Base):
     __tablename__ = "ParkingSpot"
     spot_id = Column(Integer, primary_key=True, index=True)
-    lot_id = Column(Integer, ForeignKey("ParkingLot.lot_id"), nullable=False)
+    lot_id = Column(Integer, ForeignKey("ParkingLot.lot_id"), nullable=False, index=True)
     spot_number = Column(String(50), nullable=False)
     spot_size = Column(String(50), nullable=False) # e.g., Compact, Large, Motorcycle
     status = Column(String(50), nullable=False, default='available') # e.g., available, occupied
+    version = Column(Integer, nullable=False, default=0, server_default=text("0")) # lot map_version of the last change
     lot = relationship("ParkingLot", back_populates="spots")
     tickets = relationship("Ticket", back_populates="spot")
+    __table_args__ = (
+        Index("ix_ParkingSpot_spot_size_status", "spot_size", "status"),  # spot allocation
+        Index("ix_ParkingSpot_lot_id_version", "lot_id", "version"),  # lot map deltas
+    )
 
 class Vehicle(Base):
     __tablename__ = "Vehicle"
@@ -101,12 +437,18 @@ class Ticket(Base):
     ticket_id = Column(Integer, primary_key=True, index=True)
     vehicle_id = Column(Integer, ForeignKey("Vehicle.vehicle_id"), nullable=False)
     spot_id = Column(Integer, ForeignKey("ParkingSpot.spot_id"), nullable=False)
-    entry_time = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
-    exit_time = Column(TIMESTAMP, nullable=True)
+    entry_time = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, index=True)
+    exit_time = Column(TIMESTAMP, nullable=True, index=True)
     status = Column(String(50), nullable=False, default='active') # e.g., active, paid, expired
     vehicle = relationship("Vehicle", back_populates="tickets")
     spot = relationship("ParkingSpot", back_populates="tickets")
     payment = relationship("Payment", back_populates="ticket", uselist=False)
+    __table_args__ = (
+        Index("ix_Ticket_vehicle_id_status", "vehicle_id", "status"),  # duplicate-entry check
+        Index("ix_Ticket_status_entry_time", "status", "entry_time"),  # ticket listings
+        # New SQLite databases keep a ticket id sequence, so a shard can start its own id range
+        {"sqlite_autoincrement": True},
+    )
 
 class SystemUser(Base):
     __tablename__ = "SystemUser"
@@ -130,7 +472,7 @@ class Payment(Base):
     total_amount = Column(DECIMAL(10, 2), nullable=False)
     payment_method = Column(String(50), nullable=False)
     payment_status = Column(String(50), nullable=False) # e.g., successful, failed
-    transaction_time = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+    transaction_time = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, index=True)
     processed_by_user_id = Column(Integer, ForeignKey("SystemUser.user_id"), nullable=True)
     ticket = relationship("Ticket", back_populates="payment")
     penalty = relationship("Penalty")
@@ -143,12 +485,171 @@ class ContactMessage(Base):
     message = Column(String(1000), nullable=False)
     timestamp = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
     is_resolved = Column(Boolean, default=False)
-    
+
+class OccupancyCounter(Base):
+    # Live spot counts per lot and size, updated in the same transaction as the spot itself
+    __tablename__ = "OccupancyCounter"
+    lot_id = Column(Integer, ForeignKey("ParkingLot.lot_id"), primary_key=True)
+    spot_size = Column(String(50), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    occupied = Column(Integer, nullable=False, default=0)
+
+class RevenueRollup(Base):
+    # Payments summed per hour of transaction_time; lot_id 0 / "Unknown" for payments without a ticket
+    __tablename__ = "RevenueRollup"
+    bucket_start = Column(TIMESTAMP, primary_key=True)
+    lot_id = Column(Integer, primary_key=True)
+    vehicle_type = Column(String(50), primary_key=True)
+    payment_method = Column(String(50), primary_key=True)
+    transactions = Column(Integer, nullable=False, default=0)
+    total_amount = Column(DECIMAL(14, 2), nullable=False, default=0)
+    base_fee = Column(DECIMAL(14, 2), nullable=False, default=0)
+    penalty_amount = Column(DECIMAL(14, 2), nullable=False, default=0)
+
+class OccupancyRollup(Base):
+    # Tickets counted per hour of entry_time; exits and stay_seconds are added to the entry hour on exit
+    __tablename__ = "OccupancyRollup"
+    bucket_start = Column(TIMESTAMP, primary_key=True)
+    lot_id = Column(Integer, primary_key=True)
+    vehicle_type = Column(String(50), primary_key=True)
+    entries = Column(Integer, nullable=False, default=0)
+    exits = Column(Integer, nullable=False, default=0)
+    stay_seconds = Column(Integer, nullable=False, default=0)
+
+class IdempotencyKey(Base):
+    # Results of requests already applied, so a client retrying with the same key gets the same answer
+    __tablename__ = "IdempotencyKey"
+    key = Column(String(100), primary_key=True)
+    scope = Column(String(50), nullable=False)  # which endpoint applied it
+    status_code = Column(Integer, nullable=False)
+    response = Column(Text, nullable=False)  # JSON body
+    created_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, index=True)
+
+class SchemaVersion(Base):
+    __tablename__ = "SchemaVersion"
+    version = Column(Integer, primary_key=True)
+    description = Column(String(255), nullable=False)
+    applied_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow)
+
+# --- Schema Migrations ---
+# Each migration runs once per database, in order, and is recorded in SchemaVersion.
+# Migrations must be safe on a fresh database, where migration 1 already created
+# every table and index in the current models.
+def _create_tables(connection):
+    Base.metadata.create_all(bind=connection)
+
+# Indexes migration 2 shipped with; later indexes belong to the migration that adds their columns
+HOT_QUERY_INDEXES = {
+    ParkingSpot: ("ix_ParkingSpot_lot_id", "ix_ParkingSpot_spot_id", "ix_ParkingSpot_spot_size_status"),
+    Ticket: ("ix_Ticket_entry_time", "ix_Ticket_exit_time", "ix_Ticket_status_entry_time",
+             "ix_Ticket_ticket_id", "ix_Ticket_vehicle_id_status"),
+    Payment: ("ix_Payment_payment_id", "ix_Payment_transaction_time"),
+}
+
+def _create_indexes(connection, model, *index_names):
+    indexes = {index.name: index for index in model.__table__.indexes}
+    for name in index_names:
+        indexes[name].create(bind=connection, checkfirst=True)
+
+def _create_hot_query_indexes(connection):
+    for model, index_names in HOT_QUERY_INDEXES.items():
+        _create_indexes(connection, model, *index_names)
+
+def _create_occupancy_counters(connection):
+    # Filled in by reconcile_occupancy on startup
+    OccupancyCounter.__table__.create(bind=connection, checkfirst=True)
+
+def _add_missing_columns(connection, model, *column_names):
+    existing = {column["name"] for column in inspect(connection).get_columns(model.__tablename__)}
+    table_name = connection.dialect.identifier_preparer.format_table(model.__table__)
+    for name in column_names:
+        if name not in existing:
+            column_ddl = CreateColumn(model.__table__.c[name]).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}")
+
+def _add_lot_map_versions(connection):
+    _add_missing_columns(connection, ParkingLot, "map_version")
+    _add_missing_columns(connection, ParkingSpot, "version")
+    _create_indexes(connection, ParkingSpot, "ix_ParkingSpot_lot_id_version")
+
+def _create_vehicle_search_index(connection):
+    if connection.dialect.name == "postgresql":
+        # Lets ILIKE '%fragment%' on plates use an index instead of scanning Vehicle
+        connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        connection.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS "ix_Vehicle_vehicle_number_trgm" '
+            'ON "Vehicle" USING gin (vehicle_number gin_trgm_ops)'
+        )
+    elif connection.dialect.name == "sqlite":
+        if not SQLITE_HAS_TRIGRAM:
+            print(f"--- SQLite {sqlite3.sqlite_version} has no trigram tokenizer; plate search will scan ---")
+            return
+        # External-content FTS5 table over Vehicle, kept in sync by triggers
+        connection.exec_driver_sql(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS "VehicleSearch" USING fts5('
+            "vehicle_number, content='Vehicle', content_rowid='vehicle_id', tokenize='trigram')"
+        )
+        connection.exec_driver_sql(
+            'CREATE TRIGGER IF NOT EXISTS "Vehicle_search_insert" AFTER INSERT ON "Vehicle" BEGIN '
+            'INSERT INTO "VehicleSearch"(rowid, vehicle_number) VALUES (new.vehicle_id, new.vehicle_number); END'
+        )
+        connection.exec_driver_sql(
+            'CREATE TRIGGER IF NOT EXISTS "Vehicle_search_delete" AFTER DELETE ON "Vehicle" BEGIN '
+            'INSERT INTO "VehicleSearch"("VehicleSearch", rowid, vehicle_number) '
+            "VALUES ('delete', old.vehicle_id, old.vehicle_number); END"
+        )
+        connection.exec_driver_sql(
+            'CREATE TRIGGER IF NOT EXISTS "Vehicle_search_update" AFTER UPDATE ON "Vehicle" BEGIN '
+            'INSERT INTO "VehicleSearch"("VehicleSearch", rowid, vehicle_number) '
+            "VALUES ('delete', old.vehicle_id, old.vehicle_number); "
+            'INSERT INTO "VehicleSearch"(rowid, vehicle_number) VALUES (new.vehicle_id, new.vehicle_number); END'
+        )
+        connection.exec_driver_sql('INSERT INTO "VehicleSearch"("VehicleSearch") VALUES (\'rebuild\')')
+
+def _create_report_rollups(connection):
+    RevenueRollup.__table__.create(bind=connection, checkfirst=True)
+    OccupancyRollup.__table__.create(bind=connection, checkfirst=True)
+    backfill_rollups(connection)
+
+def _create_idempotency_keys(connection):
+    IdempotencyKey.__table__.create(bind=connection, checkfirst=True)
+
+MIGRATIONS = [
+    (1, "create tables", _create_tables),
+    (2, "indexes for allocation, duplicate-entry, report and lot map queries", _create_hot_query_indexes),
+    (3, "occupancy counters", _create_occupancy_counters),
+    (4, "lot map versions", _add_lot_map_versions),
+    (5, "vehicle number search index", _create_vehicle_search_index),
+    (6, "hourly revenue and occupancy rollups", _create_report_rollups),
+    (7, "idempotency keys", _create_idempotency_keys),
+]
+
+def run_migrations(db_engine):
+    with db_engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Workers starting together must not apply the same migration twice
+            connection.execute(select(func.pg_advisory_xact_lock(7275)))
+        SchemaVersion.__table__.create(bind=connection, checkfirst=True)
+        applied = set(connection.execute(select(SchemaVersion.version)).scalars())
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            print(f"--- Applying schema migration {version}: {description} ---")
+            migrate(connection)
+            connection.execute(insert(SchemaVersion).values(version=version, description=description))
+
 # --- Pydantic Models ---
 
 class TokenData(BaseModel):
     username: Optional[str] = None
     role: Optional[str] = None
+    user_id: Optional[int] = None
+    principals_generation: Optional[int] = None
+
+class CurrentUser(BaseModel):
+    user_id: Optional[int]
+    username: str
+    role: str
 
 class AuthResponse(BaseModel):
     access_token: str
@@ -163,6 +664,7 @@ class EntryConfigResponse(BaseModel):
 class EntryTicketRequest(BaseModel):
     vehicle_number: str
     vehicle_type: str
+    lot_id: Optional[int] = None # Lot of the gate; the entry goes to the database of its site
 
 class EntryTicketResponse(BaseModel):
     ticket_id: int
@@ -185,6 +687,36 @@ class ExitPaymentRequest(BaseModel):
     amount_paid: float
     payment_method: str
 
+class GateEvent(BaseModel):
+    idempotency_key: str = Field(..., min_length=1, max_length=100)
+    type: Literal["entry", "exit"]
+    occurred_at: datetime # Gate clock when the car passed
+    vehicle_number: Optional[str] = None # Entry; or exit of a ticket the gate issued while offline
+    vehicle_type: Optional[str] = None # Entry
+    ticket_id: Optional[int] = None # Exit
+    amount_paid: Optional[float] = None # Exit
+    payment_method: Optional[str] = None # Exit
+
+class GateEventBatch(BaseModel):
+    events: List[GateEvent] = Field(..., max_length=1000)
+    lot_id: Optional[int] = None # Lot of the gate; the batch goes to the database of its site
+
+class GateEventResult(BaseModel):
+    idempotency_key: str
+    status_code: int # 201 entry, 200 exit, 4xx rejected
+    detail: Optional[str] = None
+    duplicate: bool = False # Already applied by an earlier request; this is the original result
+    ticket_id: Optional[int] = None
+    spot_id: Optional[int] = None
+    spot_number: Optional[str] = None
+    payment_id: Optional[int] = None
+
+class GateEventBatchResponse(BaseModel):
+    applied: int
+    duplicates: int
+    rejected: int
+    results: List[GateEventResult]
+
 class ExitPaymentResponse(BaseModel):
     payment_id: int
     payment_status: str
@@ -213,6 +745,10 @@ class LotMapResponse(BaseModel):
     lot_id: int
     lot_name: str
     spots_array: List[SpotStatus]
+    version: int = 0
+    changed_since: Optional[int] = None  # set when spots_array only holds spots changed after this version
+    status_bitmap: Optional[str] = None  # base64, one bit per spot in map order, 1 = occupied
+    spot_count: Optional[int] = None
 
 # Admin Tickets
 class TicketResponse(BaseModel):
@@ -228,6 +764,13 @@ class TicketResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class VehicleSearchResult(BaseModel):
+    vehicle_id: int
+    vehicle_number: str
+    vehicle_type: str
+    class Config:
+        from_attributes = True
+
 class PaymentDetail(BaseModel):
     payment_id: int
     base_fee: float
@@ -281,6 +824,28 @@ class OccupancyReportResponse(BaseModel):
     peak_hours_data: Dict[int, int] # Hour -> Count
     occupancy_by_lot: Dict[str, float] # Lot Name -> Average Occupancy %
     average_duration_by_vehicle_type: Dict[str, float] # Type -> Avg minutes
+    peak_occupancy_by_lot: Dict[str, float] = {} # Lot Name -> Peak Occupancy %
+    average_occupancy: float = 0.0 # All lots, %
+    peak_occupancy: float = 0.0 # All lots, %
+    resolution_minutes: int = 60
+    occupancy_curve_by_lot: Optional[Dict[str, List[float]]] = None # Lot Name -> Avg % per bucket from start_date
+
+class EventSnapshotResponse(BaseModel):
+    seq: int
+    complete: bool # False: the stream only carries this worker's events, so keep polling as well
+    lots: Dict[int, Dict[str, Any]]  # lot_id -> {"name": ..., "total": {size: n}, "occupied": {size: n}}
+
+class PoolStatusResponse(BaseModel):
+    shard: int
+    replica: bool
+    pool_class: str
+    size: Optional[int]
+    checked_out: Optional[int]
+    checked_in: Optional[int]
+    overflow: Optional[int]
+    acquisitions: int
+    average_wait_ms: float
+    max_wait_ms: float
 
 class ContactMessageCreate(BaseModel):
     name: str
@@ -299,13 +864,50 @@ class ContactMessageResponse(BaseModel):
 
 
 # --- Database Dependency ---
+# Requests let through to the database at once: one pool's worth, so an admitted request never waits
+# for a connection. A request waiting for a connection would hold a threadpool thread, and once
+# waiting requests held every thread, requests holding connections could not get one to finish
+database_slots = anyio.Semaphore(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+async def database_slot():
+    """Router dependency: waits on the event loop, not on a thread, until the request may use the database."""
+    with timed_stage("db_queue"):
+        await database_slots.acquire()
+    try:
+        yield
+    finally:
+        database_slots.release()
+
 def get_db():
-    db = SessionLocal()
+    yield from shard_session(0)
+
+def get_read_db():
+    """Session for read-only admin routes: the primary's replica while it is fresh enough, otherwise the primary."""
+    yield from shard_session(0, replica=True)
+
+def get_lot_db(lot_id: int):
+    """Session on the shard that holds the lot in the path."""
+    yield from shard_session(shard_router.shard_for_lot(lot_id))
+
+def get_ticket_db(ticket_id: int):
+    """Session on the shard that issued the ticket in the path."""
+    yield from shard_session(shard_router.shard_for_ticket(ticket_id))
+
+def shard_session(shard: int, replica: bool = False):
+    db = shard_router.read_session(shard) if replica else shard_router.session(shard)
     try:
+        # Check out the connection up front so the pool wait is measured
+        started = time.perf_counter()
+        with timed_stage("pool_wait"):
+            db.connection()
+        shard_router.pool_wait_stats[db.get_bind()].record(time.perf_counter() - started)
         yield db
     finally:
         db.close()
 
+# For endpoints that find their shard in the request body
+shard_session_scope = contextmanager(shard_session)
+
 # --- Utility Functions ---
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -313,6 +915,24 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+_pending_password_checks = 0  # only touched from the event loop
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    """Runs bcrypt verification on the password pool instead of the event loop."""
+    global _pending_password_checks
+    if _pending_password_checks >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress. Please try again shortly.",
+            headers={"Retry-After": "1"},
+        )
+    _pending_password_checks += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, verify_password, plain_password, hashed_password)
+    finally:
+        _pending_password_checks -= 1
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -323,43 +943,1381 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def calculate_fee(duration_minutes: int, vehicle_type: str) -> float:
-    if duration_minutes <= 0:
-        return 0.0
-    # Define pricing tiers
-    pricing = {
-        "Motorcycle": {"first_hour": 10.0, "subsequent_hour": 5.0},
-        "Compact": {"first_hour": 25.0, "subsequent_hour": 12.0},
-        "Large": {"first_hour": 50.0, "subsequent_hour": 25.0}
+# --- Tariffs ---
+class CompiledTariffs:
+    """
+    One version of the tariff file as NumPy lookup tables.
+    Stays are charged per started hour: the first hour at first_hour, later ones at
+    subsequent_hour, each scaled by the weekend/peak multiplier of the local hour it starts
+    in. Every 24 hours from entry are capped at daily_cap; stays within grace_minutes are free.
+    """
+    def __init__(self, config: dict):
+        self.config = config
+        vehicle_types = config["vehicle_types"]
+        self.entry_config = {
+            "fee_structure_details": {
+                name: {key: rates[key] for key in ("first_hour", "subsequent_hour", "lost_ticket_penalty")}
+                for name, rates in vehicle_types.items()
+            },
+            "supported_vehicle_types": list(vehicle_types),
+        }
+        # Changes exactly when the body of GET /entry/config does
+        self.entry_config_etag = '"%s"' % hashlib.sha256(
+            json.dumps(self.entry_config, sort_keys=True).encode()
+        ).hexdigest()[:32]
+        self.type_index = {name: index for index, name in enumerate(vehicle_types)}
+        self.default_index = self.type_index[config.get("default_vehicle_type", next(iter(vehicle_types)))]
+
+        def column(key, default=None):
+            values = [rates.get(key) for rates in vehicle_types.values()]
+            return np.array([default if value is None else value for value in values], dtype=float)
+        self.first_hour = column("first_hour")
+        self.subsequent_hour = column("subsequent_hour")
+        self.grace_minutes = column("grace_minutes", 0)
+        self.daily_cap = column("daily_cap", np.inf)
+
+        # Multiplier of every hour of the week (Monday 00:00 is hour 0), laid out twice so a
+        # day starting late on Sunday can be summed without wrapping
+        week = np.ones(7 * 24)
+        week[5 * 24:] *= config.get("weekend_multiplier", 1.0)
+        for band in config.get("peak_hours", []):
+            for day in band.get("days", range(7)):
+                week[day * 24 + band["start_hour"]:day * 24 + band["end_hour"]] *= band["multiplier"]
+        self.week_cumsum = np.concatenate([[0.0], np.cumsum(np.tile(week, 2))])
+        self.flat_cumsum = np.arange(2 * 7 * 24 + 1, dtype=float)
+        self.utc_offset = np.timedelta64(int(config.get("timezone_offset_minutes", 0)), "m")
+
+    def fees(self, durations, vehicle_types, entry_times=None):
+        minutes = np.asarray(durations, dtype=np.int64)
+        index = np.array([self.type_index.get(name, self.default_index) for name in vehicle_types], dtype=np.int64)
+        first, later, cap = self.first_hour[index], self.subsequent_hour[index], self.daily_cap[index]
+        hours = np.maximum((minutes + 59) // 60, 0)
+        if entry_times is None:
+            cumsum, start_hour = self.flat_cumsum, np.zeros(len(minutes), dtype=np.int64)
+        else:
+            local = np.array(entry_times, dtype="datetime64[m]") + self.utc_offset
+            # 1970-01-01 was a Thursday, hour 72 of its week
+            start_hour = (local.astype("datetime64[h]").astype(np.int64) + 72) % (7 * 24)
+            cumsum = self.week_cumsum
+
+        total = np.zeros(len(minutes))
+        for day in range(-(-int(hours.max(initial=0)) // 24)):
+            day_hours = np.clip(hours - 24 * day, 0, 24)
+            begin = (start_hour + 24 * day) % (7 * 24)
+            charge = later * (cumsum[begin + day_hours] - cumsum[begin])
+            if day == 0:
+                charge += (first - later) * (cumsum[begin + np.minimum(day_hours, 1)] - cumsum[begin])
+            total += np.minimum(charge, cap)
+        total[minutes <= np.maximum(self.grace_minutes[index], 0)] = 0.0
+        return np.round(total, 2)
+
+class TariffEngine:
+    """Serves CompiledTariffs for TARIFF_CONFIG and recompiles them when the file changes."""
+    def __init__(self, path: str, reload_seconds: float):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self._lock = threading.Lock()
+        self._compiled: Optional[CompiledTariffs] = None
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def current(self) -> CompiledTariffs:
+        if self._compiled is None or time.monotonic() - self._checked_at >= self.reload_seconds:
+            with self._lock:
+                self._reload_if_changed()
+        return self._compiled
+
+    def _reload_if_changed(self):
+        self._checked_at = time.monotonic()
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as tariff_file:
+                compiled = CompiledTariffs(json.load(tariff_file))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            if self._compiled is None:
+                raise
+            # A half-edited file must not take the gates down; keep charging the last good tariffs
+            print(f"--- Ignoring invalid tariff file {self.path}: {e} ---")
+            return
+        self._compiled, self._mtime = compiled, mtime
+        print(f"--- Tariffs loaded from {self.path} ---")
+
+tariff_engine = TariffEngine(TARIFF_CONFIG, TARIFF_RELOAD_SECONDS)
+
+def calculate_fees(durations, vehicle_types, entry_times=None):
+    """Fees of many stays in one pass; durations in minutes. Without entry_times no time-of-day rates apply."""
+    return tariff_engine.current().fees(durations, vehicle_types, entry_times)
+
+def calculate_fee(duration_minutes: int, vehicle_type: str, entry_time: Optional[datetime] = None) -> float:
+    return float(calculate_fees([duration_minutes], [vehicle_type], None if entry_time is None else [entry_time])[0])
+
+# --- Live Events ---
+class EventBroker:
+    """
+    Fans out dashboard events (spot, ticket, payment) to every stream subscriber.
+    Each event gets a sequence number; the last EVENT_BACKLOG_SIZE events are kept
+    so a reconnecting client can resume from the last sequence number it saw.
+    With a shared event log, events are numbered there and every worker relays all of them,
+    so a client sees every worker's events and can resume on any worker.
+    """
+    def __init__(self, backlog_size: int, queue_size: int):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._backlog = deque(maxlen=backlog_size)
+        self._queue_size = queue_size
+        self._subscribers = set()
+        self._loop = None
+        self._log = None
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def complete(self) -> bool:
+        """Whether the stream carries the events of every worker."""
+        return self._log is not None or WEB_CONCURRENCY == 1
+
+    def attach(self, loop, log=None):
+        self._loop = loop
+        if log is not None:
+            # Sequence numbers now come from the log; anything published before startup was local only
+            with self._lock:
+                self._log = log
+                self._seq = 0
+                self._backlog.clear()
+
+    def publish(self, event_type: str, data: Dict[str, Any]):
+        """Safe to call from any thread."""
+        if self._log is not None:
+            # relay() delivers it, to this worker's subscribers as well
+            self._log.append_event(json.dumps([event_type, data], default=str), self._backlog.maxlen)
+            return
+        with self._lock:
+            self._seq += 1
+            message = (self._seq, event_type, data)
+            self._backlog.append(message)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._fan_out, message)
+
+    async def relay(self):
+        """Delivers the events of the shared log to this worker's subscribers, in log order."""
+        while True:
+            try:
+                logged = await run_in_threadpool(self._log.events_after, self._seq)
+            except Exception as e:
+                print(f"An error occurred while reading shared events: {e}")
+                logged = []
+            if logged and self._seq and logged[0][0] > self._seq + 1:
+                # The log dropped events before this worker read them
+                self._fan_out((logged[0][0] - 1, "resync", {}))
+            for seq, message in logged:
+                event_type, data = json.loads(message)
+                with self._lock:
+                    self._seq = seq
+                    self._backlog.append((seq, event_type, data))
+                self._fan_out((seq, event_type, data))
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    def _fan_out(self, message):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind to catch up with deltas: tell the client to reload a snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait((message[0], "resync", {}))
+
+    def subscribe(self, last_seq: Optional[int]):
+        """Returns (queue, backlog to replay first); a gap the backlog cannot fill replays a resync."""
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._subscribers.add(queue)
+            oldest = self._backlog[0][0] if self._backlog else self._seq + 1
+            if last_seq is None:
+                replay = []
+            elif last_seq < oldest - 1 or (last_seq > self._seq and self._log is None):
+                replay = [(self._seq, "resync", {})]
+            else:
+                replay = [message for message in self._backlog if message[0] > last_seq]
+        return queue, replay
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+event_broker = EventBroker(EVENT_BACKLOG_SIZE, EVENT_SUBSCRIBER_QUEUE_SIZE)
+
+def queue_event(db: Session, event_type: str, data: Dict[str, Any]):
+    # Held on the session until the transaction commits, so subscribers never see rolled-back changes
+    db.info.setdefault("queued_events", []).append((event_type, data))
+
+def publish_queued_events(db: Session):
+    events = db.info.pop("queued_events", [])
+    invalidate_cached_responses(events)
+    for event_type, data in events:
+        event_broker.publish(event_type, data)
+
+# --- Spot Allocation ---
+def spot_order(spot_number: str) -> int:
+    # "A10" is further from the entrance than "A2", so order by the numeric part
+    digits = "".join(ch for ch in spot_number if ch.isdigit())
+    return int(digits) if digits else 0
+
+class SpotAllocator:
+    """
+    Keeps the free spots of every (lot, spot_size) in memory so that an arriving
+    vehicle does not scan the ParkingSpot table. Each free-list is a heap ordered
+    by distance from the lot entrance; the policy decides which lot is used.
+    """
+    POLICIES = ("nearest", "fill_first", "spread")
+
+    def __init__(self, policy: str = "nearest"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown spot allocation policy: {policy}")
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._heaps: Dict[str, Dict[int, list]] = {}  # spot_size -> lot_id -> heap of (order, spot_id)
+        self._free_count: Dict[str, Dict[int, int]] = {}
+        self._free_ids = set()
+        self._spots: Dict[int, tuple] = {}  # spot_id -> (lot_id, spot_size, order)
+
+    def _push(self, spot_id: int):
+        lot_id, spot_size, order = self._spots[spot_id]
+        heapq.heappush(self._heaps.setdefault(spot_size, {}).setdefault(lot_id, []), (order, spot_id))
+        counts = self._free_count.setdefault(spot_size, {})
+        counts[lot_id] = counts.get(lot_id, 0) + 1
+        self._free_ids.add(spot_id)
+
+    def rebuild(self, db: Session):
+        """Reloads the free-lists from the database."""
+        rows = db.query(
+            ParkingSpot.spot_id, ParkingSpot.lot_id, ParkingSpot.spot_size,
+            ParkingSpot.spot_number, ParkingSpot.status
+        ).all()
+        with self._lock:
+            self._reset()
+            for spot_id, lot_id, spot_size, spot_number, spot_status in rows:
+                self._spots[spot_id] = (lot_id, spot_size, spot_order(spot_number))
+                if spot_status == 'available':
+                    self._push(spot_id)
+
+    def _pick_lot(self, spot_size: str) -> Optional[int]:
+        counts = {lot_id: n for lot_id, n in self._free_count.get(spot_size, {}).items() if n > 0}
+        if not counts:
+            return None
+        if self.policy == "fill_first":
+            return min(counts)
+        if self.policy == "spread":
+            return max(counts, key=lambda lot_id: (counts[lot_id], -lot_id))
+        heaps = self._heaps[spot_size]
+        return min(counts, key=lambda lot_id: (self._first_free(heaps[lot_id]), lot_id))
+
+    def _first_free(self, heap: list) -> int:
+        # Drop entries for spots that were discarded or allocated since they were pushed
+        while heap and heap[0][1] not in self._free_ids:
+            heapq.heappop(heap)
+        return heap[0][0]
+
+    def allocate(self, spot_size: str) -> Optional[int]:
+        """Takes a free spot of the given size off its free-list and returns its id."""
+        with self._lock:
+            lot_id = self._pick_lot(spot_size)
+            if lot_id is None:
+                return None
+            heap = self._heaps[spot_size][lot_id]
+            self._first_free(heap)
+            _, spot_id = heapq.heappop(heap)
+            self._free_ids.discard(spot_id)
+            self._free_count[spot_size][lot_id] -= 1
+            return spot_id
+
+    def release(self, spot_id: int):
+        """Puts a spot back on its free-list once it is available again."""
+        with self._lock:
+            if spot_id in self._spots and spot_id not in self._free_ids:
+                self._push(spot_id)
+
+    def discard(self, spot_id: int):
+        """Forgets a free spot that turned out to be taken in the database."""
+        with self._lock:
+            if spot_id in self._free_ids:
+                lot_id, spot_size, _ = self._spots[spot_id]
+                self._free_ids.discard(spot_id)
+                self._free_count[spot_size][lot_id] -= 1
+
+spot_allocator = SpotAllocator(SPOT_ALLOCATION_POLICY)
+
+# --- Shards ---
+TICKET_ID_SHARD_STRIDE = 100_000_000  # Shard n issues ticket ids from n * TICKET_ID_SHARD_STRIDE + 1
+
+# A caught-up standby has nothing to replay, however old its last replayed transaction is
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+def replica_sessionmaker(database_url: str, shard: int):
+    return sessionmaker(
+        autocommit=False, autoflush=False, bind=create_db_engine(database_url), info={"shard": shard, "replica": True}
+    )
+
+def measure_replica_lag(replica_engine: Engine) -> float:
+    """Seconds the replica is behind its primary; infinite when it cannot tell."""
+    if replica_engine.dialect.name != "postgresql":
+        return 0.0  # A SQLite copy has no replication status to read
+    try:
+        with replica_engine.connect() as connection:
+            lag = connection.execute(text(REPLICA_LAG_SQL)).scalar()
+    except Exception as e:
+        print(f"Replica lag check failed, reading from the primary: {e}")
+        return float("inf")
+    return float("inf") if lag is None else float(lag)
+
+@event.listens_for(Session, "before_flush")
+def refuse_replica_writes(session, flush_context, instances):
+    if session.info.get("replica"):
+        raise RuntimeError("Replica sessions are read-only")
+
+class ShardRouter:
+    """
+    Routes each lot to the database of its site. Shard 0 is the primary database (DATABASE_URL);
+    every other shard is a complete database holding only its own lots, tickets and payments.
+    Each shard issues ticket ids from its own range, so an exit finds the shard from the id alone.
+    A shard may also have a read-only replica that serves the admin reads which can be slightly stale.
+    """
+    def __init__(self, shards: list, replica_url: Optional[str] = None):
+        self.sessions = {0: SessionLocal}
+        self.replicas = {}
+        if replica_url:
+            self.replicas[0] = replica_sessionmaker(replica_url, 0)
+        self.allocators = {0: spot_allocator}
+        self.lot_shards: Dict[int, int] = {}
+        for shard in shards:
+            number = int(shard["shard"])
+            if number in self.sessions or not 0 < number < (2**31 - 1) // TICKET_ID_SHARD_STRIDE:
+                raise ValueError(f"Invalid or duplicate shard number: {number}")
+            self.sessions[number] = sessionmaker(
+                autocommit=False, autoflush=False, bind=create_db_engine(shard["url"]), info={"shard": number}
+            )
+            self.allocators[number] = SpotAllocator(SPOT_ALLOCATION_POLICY)
+            if shard.get("replica_url"):
+                self.replicas[number] = replica_sessionmaker(shard["replica_url"], number)
+            for lot_id in shard["lots"]:
+                self.lot_shards[int(lot_id)] = number
+        self.sharded = len(self.sessions) > 1
+        self.pool_wait_stats = {db_engine: PoolWaitStats() for _, _, db_engine in self.pools()}
+        self._replica_lag: Dict[int, tuple] = {}  # shard -> (monotonic time measured, seconds behind)
+        self._executor = None
+        if self.sharded:
+            self._executor = ThreadPoolExecutor(max_workers=SHARD_GATHER_WORKERS, thread_name_prefix="shard-gather")
+
+    def shard_for_lot(self, lot_id: Optional[int]) -> int:
+        return self.lot_shards.get(lot_id, 0)
+
+    def shard_for_ticket(self, ticket_id: int) -> int:
+        number = ticket_id // TICKET_ID_SHARD_STRIDE
+        return number if number in self.sessions else 0
+
+    def engines(self) -> Dict[int, Engine]:
+        return {number: maker.kw["bind"] for number, maker in self.sessions.items()}
+
+    def pools(self) -> list:
+        """(shard, replica, engine) of every database this worker connects to."""
+        return [(number, False, maker.kw["bind"]) for number, maker in sorted(self.sessions.items())] \
+            + [(number, True, maker.kw["bind"]) for number, maker in sorted(self.replicas.items())]
+
+    def session(self, shard: int) -> Session:
+        return self.sessions[shard]()
+
+    def read_session(self, shard: int) -> Session:
+        """Session on the shard's replica while it is within REPLICA_MAX_LAG_SECONDS, otherwise on the primary."""
+        if shard in self.replicas and self.replica_lag(shard) <= REPLICA_MAX_LAG_SECONDS:
+            return self.replicas[shard]()
+        return self.session(shard)
+
+    def replica_lag(self, shard: int) -> float:
+        now = time.monotonic()
+        measured_at, lag = self._replica_lag.get(shard, (None, None))
+        if measured_at is not None and now - measured_at < REPLICA_LAG_CHECK_SECONDS:
+            return lag
+        # Threads racing here each measure once; the last answer wins, which is as good as any
+        lag = measure_replica_lag(self.replicas[shard].kw["bind"])
+        if lag > REPLICA_MAX_LAG_SECONDS and lag != float("inf"):
+            print(f"Replica of shard {shard} is {lag:.1f}s behind; reading from the primary")
+        self._replica_lag[shard] = (now, lag)
+        return lag
+
+    def gather(self, read, replica: bool = False, shards: Optional[List[int]] = None) -> list:
+        """
+        Runs read(db) on every shard (or those in `shards`) in parallel, each in a session of its own;
+        results are in shard order. With replica=True, shards read from their replica when it is fresh enough.
+        """
+        def run(number):
+            db = self.read_session(number) if replica else self.session(number)
+            try:
+                return read(db)
+            finally:
+                db.close()
+        numbers = sorted(self.sessions if shards is None else shards)
+        if self._executor is None:
+            return [run(number) for number in numbers]
+        # Each task runs in a copy of the request context, so its queries count towards the request
+        futures = [self._executor.submit(copy_context().run, run, number) for number in numbers]
+        return [future.result() for future in futures]
+
+shard_router = ShardRouter(DATABASE_SHARDS, DATABASE_REPLICA_URL)
+
+def plates_parked_elsewhere(shard: int, plates) -> set:
+    """Plates with an active ticket at another site; a car can only be parked in one lot at a time."""
+    others = [number for number in shard_router.sessions if number != shard]
+    if not others or not plates:
+        return set()
+    parked = shard_router.gather(lambda db: db.query(Vehicle.vehicle_number).join(Ticket).filter(
+        Vehicle.vehicle_number.in_(list(plates)), Ticket.status == 'active'
+    ).all(), shards=others)
+    return {row.vehicle_number for rows in parked for row in rows}
+
+def allocator_for(db: Session) -> SpotAllocator:
+    return shard_router.allocators[db.info.get("shard", 0)]
+
+def reserve_ticket_ids(connection, shard: int):
+    """Moves the ticket id sequence of a shard's database to the start of the shard's range."""
+    if shard == 0:
+        return
+    last_id = shard * TICKET_ID_SHARD_STRIDE
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            """SELECT setval(pg_get_serial_sequence('"Ticket"', 'ticket_id'), """
+            """GREATEST(:last_id, (SELECT COALESCE(MAX(ticket_id), 0) FROM "Ticket")))"""
+        ), {"last_id": last_id})
+        return
+    if "AUTOINCREMENT" not in (connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'Ticket'")).scalar() or ""):
+        raise RuntimeError(f"Shard {shard} needs a new SQLite database so that it can issue its own ticket ids")
+    current = connection.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'Ticket'")).scalar()
+    if current is None:
+        connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('Ticket', :last_id)"), {"last_id": last_id})
+    elif current < last_id:
+        connection.execute(text("UPDATE sqlite_sequence SET seq = :last_id WHERE name = 'Ticket'"), {"last_id": last_id})
+
+def _mark_spot_occupied(db: Session, spot_id: int) -> bool:
+    # Conditional UPDATE: only one transaction can flip a given spot from available to occupied
+    result = db.execute(
+        update(ParkingSpot)
+        .where(ParkingSpot.spot_id == spot_id, ParkingSpot.status == 'available')
+        .values(status='occupied')
+    )
+    return result.rowcount == 1
+
+def record_spot_change(db: Session, spot: ParkingSpot, occupied: bool):
+    """Keeps the derived occupancy state in step with a spot that changed status."""
+    size_occupied = db.execute(
+        update(OccupancyCounter)
+        .where(OccupancyCounter.lot_id == spot.lot_id, OccupancyCounter.spot_size == spot.spot_size)
+        .values(occupied=OccupancyCounter.occupied + (1 if occupied else -1))
+        .returning(OccupancyCounter.occupied)
+    ).scalar()
+    lot_version = db.execute(
+        update(ParkingLot)
+        .where(ParkingLot.lot_id == spot.lot_id)
+        .values(map_version=ParkingLot.map_version + 1)
+        .returning(ParkingLot.map_version)
+    ).scalar()
+    spot.version = lot_version
+    # The counter is sent as an absolute value so replaying an event twice is harmless
+    queue_event(db, "spot", {
+        "spot_id": spot.spot_id,
+        "lot_id": spot.lot_id,
+        "spot_number": spot.spot_number,
+        "size": spot.spot_size,
+        "status": 'occupied' if occupied else 'available',
+        "occupied": size_occupied,
+        "version": lot_version,
+    })
+
+def claim_spot(db: Session, spot_size: str) -> Optional[ParkingSpot]:
+    """
+    Atomically marks a free spot of the given size as occupied and returns it,
+    or None when there is no free spot. The claim is part of the caller's
+    transaction, so a rollback makes the spot available again.
+    """
+    spot = _claim_free_spot(db, spot_size)
+    if spot:
+        record_spot_change(db, spot, occupied=True)
+    return spot
+
+def free_spot(db: Session, spot_id: int) -> Optional[ParkingSpot]:
+    """Marks an occupied spot as available again, as part of the caller's transaction."""
+    spot = db.query(ParkingSpot).filter(ParkingSpot.spot_id == spot_id).first()
+    if spot and spot.status == 'occupied':
+        spot.status = 'available'
+        record_spot_change(db, spot, occupied=False)
+    return spot
+
+def _claim_free_spot(db: Session, spot_size: str) -> Optional[ParkingSpot]:
+    rebuilt = False
+    for _ in range(SPOT_CLAIM_ATTEMPTS):
+        spot_id = allocator_for(db).allocate(spot_size)
+        if spot_id is None:
+            if rebuilt:
+                return None
+            # The free-lists may be stale (e.g. spots freed by another worker), so reload once
+            allocator_for(db).rebuild(db)
+            rebuilt = True
+            continue
+        if _mark_spot_occupied(db, spot_id):
+            return db.query(ParkingSpot).filter(ParkingSpot.spot_id == spot_id).first()
+        # Another gate got there first; the spot stays off the free-list
+
+    # The free-lists keep losing races, so let the database pick the spot
+    query = db.query(ParkingSpot).filter(ParkingSpot.spot_size == spot_size, ParkingSpot.status == 'available')
+    if db.bind.dialect.name == "postgresql":
+        spot = query.with_for_update(skip_locked=True).first()
+        if spot:
+            spot.status = 'occupied'
+            db.flush()
+            allocator_for(db).discard(spot.spot_id)
+        return spot
+    for _ in range(SPOT_CLAIM_ATTEMPTS):
+        spot = query.first()
+        if spot is None:
+            return None
+        if _mark_spot_occupied(db, spot.spot_id):
+            allocator_for(db).discard(spot.spot_id)
+            db.refresh(spot)
+            return spot
+    return None
+
+def reconcile_occupancy(db: Session) -> int:
+    """
+    Recomputes the occupancy counters from the ParkingSpot table and repairs any
+    drift. Returns the number of counters that had to be corrected; the caller commits.
+    """
+    if db.bind.dialect.name == "postgresql":
+        db.query(OccupancyCounter).with_for_update().all()
+    else:
+        # A no-op write takes SQLite's write lock, so no ticket or payment commits mid-count
+        db.execute(update(OccupancyCounter).where(false()).values(total=OccupancyCounter.total))
+    actual = {
+        (lot_id, spot_size): (total, occupied or 0)
+        for lot_id, spot_size, total, occupied in db.query(
+            ParkingSpot.lot_id,
+            ParkingSpot.spot_size,
+            func.count(ParkingSpot.spot_id),
+            func.sum(case((ParkingSpot.status == 'occupied', 1), else_=0))
+        ).group_by(ParkingSpot.lot_id, ParkingSpot.spot_size).all()
     }
-    # Default to Compact pricing if type is unknown
-    rates = pricing.get(vehicle_type, pricing["Compact"])
-    hours = (duration_minutes + 59) // 60  
-    if hours <= 1:
-        return rates["first_hour"]
-    return rates["first_hour"] + (hours - 1) * rates["subsequent_hour"]
+    corrected = 0
+    for counter in db.query(OccupancyCounter).all():
+        total, occupied = actual.pop((counter.lot_id, counter.spot_size), (0, 0))
+        if (counter.total, counter.occupied) != (total, occupied):
+            print(f"--- Occupancy drift for lot {counter.lot_id} {counter.spot_size}: "
+                  f"counted {counter.occupied}/{counter.total}, actual {occupied}/{total} ---")
+            counter.total, counter.occupied = total, occupied
+            corrected += 1
+    for (lot_id, spot_size), (total, occupied) in actual.items():
+        db.add(OccupancyCounter(lot_id=lot_id, spot_size=spot_size, total=total, occupied=occupied))
+        corrected += 1
+    return corrected
+
+def queue_payment_event(db: Session, payment: Payment, ticket: Optional[Ticket]):
+    queue_event(db, "payment", {
+        "payment_id": payment.payment_id,
+        "ticket_id": payment.ticket_id,
+        "vehicle_number": ticket.vehicle.vehicle_number if ticket else None,
+        "total_amount": float(payment.total_amount),
+        "payment_method": payment.payment_method,
+        "transaction_time": payment.transaction_time,
+    })
+
+def get_or_create_vehicle(db: Session, vehicle_number: str, vehicle_type: str) -> Vehicle:
+    vehicle = db.query(Vehicle).filter(Vehicle.vehicle_number == vehicle_number).first()
+    if vehicle:
+        return vehicle
+    try:
+        with db.begin_nested():
+            vehicle = Vehicle(vehicle_number=vehicle_number, vehicle_type=vehicle_type)
+            db.add(vehicle)
+        return vehicle
+    except IntegrityError:
+        # Another gate registered the same vehicle between our SELECT and INSERT
+        return db.query(Vehicle).filter(Vehicle.vehicle_number == vehicle_number).first()
+
+# --- Report Rollups ---
+# The reports read whole hours from these tables and only the partial hours at the
+# edges of the requested range from Ticket and Payment.
+def hour_bucket(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def upsert_rollup(db: Session, model, key: dict, increments: dict):
+    """Adds `increments` to the rollup row at `key`, creating the row if needed."""
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        stmt = (pg_insert if dialect == "postgresql" else sqlite_insert)(model).values(**key, **increments)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(key),
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in increments},
+        )
+        db.execute(stmt)
+        return
+    matched = db.execute(
+        update(model).filter_by(**key).values({name: getattr(model, name) + value for name, value in increments.items()})
+    ).rowcount
+    if not matched:
+        db.execute(insert(model).values(**key, **increments))
+
+class RollupBuffer:
+    """Collects rollup increments from many events and writes one upsert per touched row."""
+    def __init__(self):
+        self._rows = {}  # (model, key items) -> increments
+
+    def add(self, db: Session, model, key: dict, increments: dict):
+        # An entry and an exit of the same hour add to different columns of one row
+        totals = self._rows.setdefault((model, tuple(key.items())), {})
+        for name, value in increments.items():
+            totals[name] = totals.get(name, 0) + value
+
+    def flush(self, db: Session):
+        for (model, key), increments in self._rows.items():
+            upsert_rollup(db, model, dict(key), increments)
+        self._rows.clear()
+
+def record_entry_rollup(db: Session, ticket: Ticket, spot: ParkingSpot, vehicle: Vehicle, upsert=upsert_rollup):
+    upsert(db, OccupancyRollup, {
+        "bucket_start": hour_bucket(ticket.entry_time), "lot_id": spot.lot_id, "vehicle_type": vehicle.vehicle_type,
+    }, {"entries": 1})
+
+def record_exit_rollups(db: Session, payment: Payment, ticket: Optional[Ticket], upsert=upsert_rollup):
+    """Call after the payment is flushed, so transaction_time is set."""
+    lot_id = ticket.spot.lot_id if ticket else 0
+    vehicle_type = ticket.vehicle.vehicle_type if ticket else "Unknown"
+    upsert(db, RevenueRollup, {
+        "bucket_start": hour_bucket(payment.transaction_time), "lot_id": lot_id,
+        "vehicle_type": vehicle_type, "payment_method": payment.payment_method,
+    }, {
+        "transactions": 1,
+        "total_amount": payment.total_amount,
+        "base_fee": payment.base_fee,
+        "penalty_amount": payment.penalty.amount if payment.penalty_id else 0,
+    })
+    if ticket and ticket.exit_time:
+        upsert(db, OccupancyRollup, {
+            "bucket_start": hour_bucket(ticket.entry_time), "lot_id": lot_id, "vehicle_type": vehicle_type,
+        }, {"exits": 1, "stay_seconds": int((ticket.exit_time - ticket.entry_time).total_seconds())})
+
+def backfill_rollups(connection):
+    """Rebuilds both rollup tables from Ticket and Payment."""
+    if connection.dialect.name == "postgresql":
+        # Gate transactions wait for the rebuild instead of adding to rows it is about to replace
+        connection.exec_driver_sql('LOCK TABLE "RevenueRollup", "OccupancyRollup" IN EXCLUSIVE MODE')
+    connection.execute(RevenueRollup.__table__.delete())
+    connection.execute(OccupancyRollup.__table__.delete())
+
+    revenue = {}
+    payments = select(
+        Payment.transaction_time, Payment.payment_method, Payment.total_amount, Payment.base_fee,
+        Penalty.amount, ParkingSpot.lot_id, Vehicle.vehicle_type
+    ).select_from(Payment) \
+     .outerjoin(Penalty, Payment.penalty_id == Penalty.penalty_id) \
+     .outerjoin(Ticket, Payment.ticket_id == Ticket.ticket_id) \
+     .outerjoin(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+     .outerjoin(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id)
+    for transaction_time, method, total_amount, base_fee, penalty_amount, lot_id, vehicle_type in connection.execute(payments):
+        key = (hour_bucket(transaction_time), lot_id or 0, vehicle_type or "Unknown", method)
+        totals = revenue.setdefault(key, [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += total_amount
+        totals[2] += base_fee
+        totals[3] += penalty_amount or 0
+
+    occupancy = {}
+    tickets = select(Ticket.entry_time, Ticket.exit_time, ParkingSpot.lot_id, Vehicle.vehicle_type) \
+        .join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+        .join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id)
+    for entry_time, exit_time, lot_id, vehicle_type in connection.execute(tickets):
+        totals = occupancy.setdefault((hour_bucket(entry_time), lot_id, vehicle_type), [0, 0, 0])
+        totals[0] += 1
+        if exit_time:
+            totals[1] += 1
+            totals[2] += int((exit_time - entry_time).total_seconds())
+
+    if revenue:
+        connection.execute(insert(RevenueRollup), [{
+            "bucket_start": bucket, "lot_id": lot_id, "vehicle_type": vehicle_type, "payment_method": method,
+            "transactions": transactions, "total_amount": total_amount, "base_fee": base_fee, "penalty_amount": penalty_amount,
+        } for (bucket, lot_id, vehicle_type, method), (transactions, total_amount, base_fee, penalty_amount) in revenue.items()])
+    if occupancy:
+        connection.execute(insert(OccupancyRollup), [{
+            "bucket_start": bucket, "lot_id": lot_id, "vehicle_type": vehicle_type,
+            "entries": entries, "exits": exits, "stay_seconds": stay_seconds,
+        } for (bucket, lot_id, vehicle_type), (entries, exits, stay_seconds) in occupancy.items()])
+    print(f"--- Rollups rebuilt: {len(revenue)} revenue rows, {len(occupancy)} occupancy rows ---")
+
+def split_report_range(start_date: datetime, end_date: datetime):
+    """The whole hours inside [start_date, end_date] as (first_hour, last_hour), or (None, None) if there are none."""
+    first_hour = hour_bucket(start_date)
+    if first_hour < start_date:
+        first_hour += timedelta(hours=1)
+    last_hour = hour_bucket(end_date)
+    if last_hour <= first_hour:
+        return None, None
+    return first_hour, last_hour
+
+def raw_edges_filter(column, start_date: datetime, end_date: datetime, first_hour, last_hour):
+    """Rows of [start_date, end_date] that fall outside the whole hours served by the rollups."""
+    if first_hour is None:
+        return column.between(start_date, end_date)
+    return or_(
+        and_(column >= start_date, column < first_hour),
+        and_(column >= last_hour, column <= end_date),
+    )
+
+# --- Occupancy Engine ---
+def to_naive_utc(moment: datetime) -> datetime:
+    # Ticket times are stored as naive UTC
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+def occupancy_sweep(entry_seconds, exit_seconds, capacity: int, window_seconds: int, resolution_seconds: int):
+    """
+    Sweeps stay intervals (seconds since the window start) across [0, window_seconds).
+    Returns (average %, peak %, per-bucket average % curve) for `capacity` spots.
+    """
+    buckets = -(-window_seconds // resolution_seconds)
+    if capacity <= 0 or buckets == 0:
+        return 0.0, 0.0, [0.0] * buckets
+    boundaries = np.minimum(np.arange(buckets + 1, dtype=np.int64) * resolution_seconds, window_seconds)
+    # Cars parked before the window are counted from its start; bucket boundaries are zero-change
+    # events, so no constant-level segment below crosses into the next bucket
+    times = np.concatenate([np.clip(entry_seconds, 0, window_seconds), np.clip(exit_seconds, 0, window_seconds), boundaries])
+    changes = np.concatenate([
+        np.ones(len(entry_seconds), dtype=np.int64),
+        -np.ones(len(exit_seconds), dtype=np.int64),
+        np.zeros(len(boundaries), dtype=np.int64),
+    ])
+    # At equal times departures sort before arrivals, so a spot handed over is not counted twice
+    order = np.lexsort((changes, times))
+    times = times[order]
+    levels = np.cumsum(changes[order])[:-1]
+    durations = np.diff(times)
+    bucket_of_segment = np.minimum(times[:-1] // resolution_seconds, buckets - 1)
+    occupied = np.bincount(bucket_of_segment, weights=levels * durations, minlength=buckets)
+
+    average = float(occupied.sum()) / (capacity * window_seconds) * 100
+    peak = float(levels[durations > 0].max(initial=0)) / capacity * 100
+    curve = occupied / (np.diff(boundaries) * capacity) * 100
+    return round(average, 2), round(peak, 2), [round(float(value), 2) for value in curve]
+
+def occupancy_inputs(db: Session, window_start: datetime, window_end: datetime):
+    """Stays overlapping the window, spot capacity per lot and lot names of one shard."""
+    stays = db.query(ParkingSpot.lot_id, Ticket.entry_time, Ticket.exit_time) \
+        .join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+        .filter(
+            Ticket.entry_time <= window_end,
+            or_(Ticket.exit_time >= window_start, Ticket.exit_time.is_(None))
+        ).all()
+    capacities = dict(db.query(OccupancyCounter.lot_id, func.sum(OccupancyCounter.total)).group_by(OccupancyCounter.lot_id).all())
+    return stays, capacities, db.query(ParkingLot.lot_id, ParkingLot.name).all()
+
+def compute_lot_occupancy(start_date: datetime, end_date: datetime, resolution_minutes: int):
+    """
+    Average and peak occupancy per lot (and across all lots of every site) from ticket stays in
+    [start_date, end_date]. Every overlapping stay is loaded, so callers keep the range short.
+    """
+    window_start = to_naive_utc(start_date).replace(microsecond=0)
+    # The future has no occupancy yet; active tickets are counted as parked until now
+    window_end = min(to_naive_utc(end_date), datetime.utcnow())
+    window_seconds = max(int((window_end - window_start).total_seconds()), 0)
+    resolution_seconds = resolution_minutes * 60
+
+    # Lot ids are unique across shards, so the inputs of every site can be swept together
+    stays, capacities, lots = [], {}, []
+    for shard_stays, shard_capacities, shard_lots in shard_router.gather(
+        lambda db: occupancy_inputs(db, window_start, window_end), replica=True
+    ):
+        stays += shard_stays
+        capacities.update(shard_capacities)
+        lots += shard_lots
+    origin = np.datetime64(window_start, "s")
+    lot_ids = np.array([lot_id for lot_id, _, _ in stays], dtype=np.int64)
+    entry_seconds = (np.array([entry for _, entry, _ in stays], dtype="datetime64[s]") - origin).astype(np.int64)
+    exit_seconds = (np.array([exit_time or window_end for _, _, exit_time in stays], dtype="datetime64[s]") - origin).astype(np.int64)
+
+    by_lot = {}
+    for lot_id, name in lots:
+        in_lot = lot_ids == lot_id
+        by_lot[name] = occupancy_sweep(
+            entry_seconds[in_lot], exit_seconds[in_lot], int(capacities.get(lot_id) or 0), window_seconds, resolution_seconds
+        )
+    overall = occupancy_sweep(entry_seconds, exit_seconds, int(sum(capacities.values())), window_seconds, resolution_seconds)
+    return by_lot, overall
+
+# --- Exports ---
+EXPORT_COLUMNS = [
+    "ticket_id", "vehicle_number", "vehicle_type", "lot_id", "lot_name", "spot_number",
+    "entry_time", "exit_time", "status", "payment_id", "base_fee", "penalty_amount",
+    "total_amount", "payment_method", "payment_status", "transaction_time",
+]
+
+def export_statement(start_date: Optional[datetime], end_date: Optional[datetime],
+                     lot_id: Optional[int], after_ticket_id: Optional[int]):
+    """Tickets with their payment, in ticket_id order so an interrupted download can resume."""
+    stmt = select(
+        Ticket.ticket_id, Vehicle.vehicle_number, Vehicle.vehicle_type, ParkingLot.lot_id, ParkingLot.name,
+        ParkingSpot.spot_number, Ticket.entry_time, Ticket.exit_time, Ticket.status, Payment.payment_id,
+        Payment.base_fee, Penalty.amount, Payment.total_amount, Payment.payment_method,
+        Payment.payment_status, Payment.transaction_time
+    ).select_from(Ticket) \
+     .join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id) \
+     .join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+     .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.lot_id) \
+     .outerjoin(Payment, Ticket.ticket_id == Payment.ticket_id) \
+     .outerjoin(Penalty, Payment.penalty_id == Penalty.penalty_id)
+    if start_date:
+        stmt = stmt.where(Ticket.entry_time >= start_date)
+    if end_date:
+        stmt = stmt.where(Ticket.entry_time < end_date)
+    if lot_id:
+        stmt = stmt.where(ParkingSpot.lot_id == lot_id)
+    if after_ticket_id:
+        stmt = stmt.where(Ticket.ticket_id > after_ticket_id)
+    # yield_per streams from a server-side cursor on Postgres
+    return stmt.order_by(Ticket.ticket_id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+def export_batches(stmt):
+    # Runs while the response body is sent, after the request's own session has been closed.
+    # Every ticket id of shard n is below those of shard n + 1, so reading the shards in turn keeps ticket_id order
+    for shard in sorted(shard_router.sessions):
+        db = shard_router.read_session(shard)
+        try:
+            for batch in db.execute(stmt).partitions():
+                yield batch
+        finally:
+            db.close()
+
+def export_csv(stmt):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in export_batches(stmt):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+class ChunkSink:
+    """Write-only file object that hands out what has been written so far."""
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def export_parquet(stmt):
+    money = pa.decimal128(14, 2)
+    schema = pa.schema([
+        ("ticket_id", pa.int64()), ("vehicle_number", pa.string()), ("vehicle_type", pa.string()),
+        ("lot_id", pa.int64()), ("lot_name", pa.string()), ("spot_number", pa.string()),
+        ("entry_time", pa.timestamp("us")), ("exit_time", pa.timestamp("us")), ("status", pa.string()),
+        ("payment_id", pa.int64()), ("base_fee", money), ("penalty_amount", money), ("total_amount", money),
+        ("payment_method", pa.string()), ("payment_status", pa.string()), ("transaction_time", pa.timestamp("us")),
+    ])
+    sink = ChunkSink()
+    # One row group per batch, flushed to the client as soon as it is written
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in export_batches(stmt):
+            columns = zip(*batch)
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+            ))
+            yield sink.drain()
+    yield sink.drain()
+
+# --- Vehicle Search ---
+# FTS5's trigram tokenizer arrived in SQLite 3.34
+SQLITE_HAS_TRIGRAM = sqlite3.sqlite_version_info >= (3, 34, 0)
+vehicle_search = table("VehicleSearch", column("rowid"), column("vehicle_number"))
+
+def normalize_plate(vehicle_number: str) -> str:
+    return vehicle_number.strip().upper()
+
+def vehicle_number_filter(db: Session, fragment: str):
+    """Substring match on plate numbers that an index can answer."""
+    fragment = normalize_plate(fragment)
+    if len(fragment) < 3:
+        # Too short for trigrams; treat it as a prefix, which the unique index on vehicle_number serves
+        return and_(Vehicle.vehicle_number >= fragment, Vehicle.vehicle_number < fragment + "\U0010ffff")
+    if db.get_bind().dialect.name == "sqlite" and SQLITE_HAS_TRIGRAM:
+        phrase = '"' + fragment.replace('"', '""') + '"'
+        return Vehicle.vehicle_id.in_(select(vehicle_search.c.rowid).where(vehicle_search.c.vehicle_number.match(phrase)))
+    # pg_trgm serves this on Postgres
+    return Vehicle.vehicle_number.icontains(fragment, autoescape=True)
+
+# --- Principal Cache ---
+class PrincipalCache:
+    """
+    LRU of authenticated users keyed by token subject; entries expire after a TTL, or when the
+    shared "principals" generation moves because a user was changed on any worker.
+    """
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # username -> (expires_at, generation, CurrentUser)
+
+    def get(self, username: str, generation: Optional[int]) -> Optional[CurrentUser]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            expires_at, cached_generation, principal = entry
+            if expires_at < time.monotonic() or cached_generation != generation:
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return principal
+
+    def put(self, principal: CurrentUser, generation: Optional[int]):
+        with self._lock:
+            self._entries[principal.username] = (time.monotonic() + self.ttl_seconds, generation, principal)
+            self._entries.move_to_end(principal.username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+@event.listens_for(SystemUser, "after_update")
+@event.listens_for(SystemUser, "after_delete")
+def _queue_principal_invalidation(mapper, connection, target):
+    # Held until commit: invalidating at flush would let a concurrent lookup cache the old row
+    # under the new generation. A renamed user must also drop the entry cached under the old name
+    state = inspect(target)
+    state.session.info.setdefault("changed_principals", set()).update([target.username, *state.attrs.username.history.deleted])
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_principals(session):
+    usernames = session.info.pop("changed_principals", None)
+    if usernames:
+        for username in usernames:
+            principal_cache.invalidate(username)
+        # Other workers drop their copies when they next see the generation
+        response_cache.invalidate("principals")
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_principals(session):
+    session.info.pop("changed_principals", None)
+
+# --- Idempotency ---
+class IdempotencyStore:
+    """
+    Responses of applied gate requests by Idempotency-Key. The IdempotencyKey table is shared
+    by every worker; a small LRU in front of it answers repeat retries without a query.
+    """
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, scope, status_code, body)
+
+    def _cache(self, key: str, entry: tuple):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def lookup(self, db: Session, key: str, scope: str):
+        """Returns (status_code, JSON body) of the request first applied with `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+        if entry is None:
+            now = datetime.utcnow()
+            row = db.query(IdempotencyKey).filter(
+                IdempotencyKey.key == key,
+                IdempotencyKey.created_at >= now - timedelta(seconds=self.ttl_seconds)
+            ).first()
+            if not row:
+                return None
+            remaining = self.ttl_seconds - (now - row.created_at).total_seconds()
+            entry = (time.monotonic() + remaining, row.scope, row.status_code, row.response)
+            self._cache(key, entry)
+        _, stored_scope, status_code, body = entry
+        if stored_scope != scope:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        return status_code, body
+
+    def record(self, db: Session, key: str, scope: str, status_code: int, content) -> tuple:
+        """Stores the response in the caller's transaction; pass the result to remember() after commit."""
+        body = json.dumps(jsonable_encoder(content))
+        db.add(IdempotencyKey(key=key, scope=scope, status_code=status_code, response=body))
+        return key, (time.monotonic() + self.ttl_seconds, scope, status_code, body)
+
+    def remember(self, recorded: tuple):
+        self._cache(*recorded)
+
+    def prune(self, db: Session) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        return db.query(IdempotencyKey).filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SECONDS)
+
+def idempotent_replay(db: Session, key: Optional[str], scope: str) -> Optional[Response]:
+    if not key:
+        return None
+    stored = idempotency_store.lookup(db, key, scope)
+    if stored is None:
+        return None
+    status_code, body = stored
+    return Response(content=body, status_code=status_code, media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+def trusted_response(content, response: Optional[Response] = None):
+    """
+    Returns a body built from typed columns without re-validating it against the route's
+    response_model (which still documents it). The content must already match the model
+    field for field, in order, with JSON-ready values. Headers set on `response` are kept.
+    """
+    if not TRUSTED_FAST_RESPONSES:
+        return content
+    return ORJSONResponse(content, headers=dict(response.headers) if response else None)
+
+# --- Response Cache ---
+class LocalCacheBackend:
+    """LRU of serialized responses in this worker; each entry expires after its own TTL."""
+    shared = False  # counters start over on restart and are not seen by other workers
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, body)
+        self._counters: Dict[str, int] = {}  # Kept apart so eviction never resets a generation
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, body = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key: str, body: str, ttl_seconds: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def counter(self, key: str) -> Optional[int]:
+        return self._counters.get(key, 0)
+
+    def incr(self, key: str):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+class RedisCacheBackend:
+    """Serialized responses shared by every worker. A server that cannot be reached counts as a miss."""
+    shared = True
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.25, decode_responses=True)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self.client.get(key)
+        except redis.RedisError as e:
+            print(f"--- Response cache unavailable: {e} ---")
+            return None
+
+    def set(self, key: str, body: str, ttl_seconds: float):
+        try:
+            self.client.set(key, body, px=int(ttl_seconds * 1000))
+        except redis.RedisError as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    def counter(self, key: str) -> Optional[int]:
+        try:
+            return int(self.client.get(key) or 0)
+        except redis.RedisError as e:
+            print(f"--- Response cache unavailable: {e} ---")
+            return None
+
+    def incr(self, key: str):
+        try:
+            self.client.incr(key)
+        except redis.RedisError as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    # Numbering and storing an event in one step, so the log never holds a gap that fills in later
+    APPEND_EVENT = """
+        local seq = redis.call('INCR', KEYS[1])
+        redis.call('ZADD', KEYS[2], seq, seq .. ' ' .. ARGV[1])
+        redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+    """
+
+    def append_event(self, message: str, keep: int):
+        try:
+            self.client.eval(self.APPEND_EVENT, 2, "events:seq", "events:log", message, keep)
+        except redis.RedisError as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    def events_after(self, seq: int) -> list:
+        members = self.client.zrangebyscore("events:log", f"({seq}", "+inf")
+        return [(int(number), message) for number, message in (member.split(" ", 1) for member in members)]
+
+class SqliteCacheBackend:
+    """
+    Serialized responses in a SQLite file shared by the workers of one host. Expiry uses the wall
+    clock, which every process agrees on; expired and surplus entries are pruned every few writes.
+    """
+    PRUNE_EVERY = 256
+    shared = True
+
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()  # sqlite3 connections stay on the thread that opened them
+        self._writes = 0
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS CacheEntry (key TEXT PRIMARY KEY, body TEXT NOT NULL, expires_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_CacheEntry_expires_at ON CacheEntry (expires_at)")
+        connection.execute("CREATE TABLE IF NOT EXISTS CacheCounter (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        # Writers take turns, so events commit in sequence order
+        connection.execute("CREATE TABLE IF NOT EXISTS CacheEvent (seq INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            row = self._connection().execute(
+                "SELECT body FROM CacheEntry WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"--- Response cache unavailable: {e} ---")
+            return None
+        return row[0] if row else None
+
+    def set(self, key: str, body: str, ttl_seconds: float):
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO CacheEntry (key, body, expires_at) VALUES (?, ?, ?)",
+                (key, body, time.time() + ttl_seconds)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                connection.execute("DELETE FROM CacheEntry WHERE expires_at < ?", (time.time(),))
+                # Past maxsize, drop the entries closest to expiring
+                connection.execute(
+                    "DELETE FROM CacheEntry WHERE key IN (SELECT key FROM CacheEntry ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.maxsize,)
+                )
+        except sqlite3.Error as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    def counter(self, key: str) -> Optional[int]:
+        try:
+            row = self._connection().execute("SELECT value FROM CacheCounter WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"--- Response cache unavailable: {e} ---")
+            return None
+        return row[0] if row else 0
+
+    def incr(self, key: str):
+        try:
+            self._connection().execute(
+                "INSERT INTO CacheCounter (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1",
+                (key,)
+            )
+        except sqlite3.Error as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    def append_event(self, message: str, keep: int):
+        try:
+            connection = self._connection()
+            seq = connection.execute("INSERT INTO CacheEvent (message) VALUES (?)", (message,)).lastrowid
+            if seq % self.PRUNE_EVERY == 0:
+                connection.execute("DELETE FROM CacheEvent WHERE seq <= ?", (seq - keep,))
+        except sqlite3.Error as e:
+            print(f"--- Response cache unavailable: {e} ---")
+
+    def events_after(self, seq: int) -> list:
+        return self._connection().execute("SELECT seq, message FROM CacheEvent WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+
+class ResponseCache:
+    """
+    Serialized responses keyed by endpoint and parameters. Every key embeds the generation of its
+    namespace, so bumping a generation drops all of its entries without having to find them:
+    "live" moves on every ticket or payment write, "history" only when one is recorded for an
+    earlier day (an offline terminal being replayed).
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get_or_set(self, key: str, ttl_seconds: float, compute, namespace: str = "live") -> str:
+        # Read the generation first: a write landing while compute() runs moves readers to a new key
+        generation = self.generation(namespace)
+        if generation is None:
+            return compute()
+        namespaced_key = f"{namespace}:{generation}:{key}"
+        body = self.backend.get(namespaced_key)
+        if body is None:
+            body = compute()
+            self.backend.set(namespaced_key, body, ttl_seconds)
+        return body
+
+    def generation(self, namespace: str) -> Optional[int]:
+        return self.backend.counter(f"generation:{namespace}")
+
+    def invalidate(self, namespace: str = "live"):
+        self.backend.incr(f"generation:{namespace}")
+
+def create_response_cache_backend():
+    if RESPONSE_CACHE_BACKEND == "redis":
+        if redis is not None:
+            return RedisCacheBackend(RESPONSE_CACHE_URL)
+        print("--- redis is not installed; falling back to the in-process response cache ---")
+    elif RESPONSE_CACHE_BACKEND == "sqlite":
+        return SqliteCacheBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE)
+    elif RESPONSE_CACHE_BACKEND != "local":
+        raise ValueError(f"Unknown response cache backend: {RESPONSE_CACHE_BACKEND}")
+    return LocalCacheBackend(RESPONSE_CACHE_SIZE)
+
+response_cache = ResponseCache(create_response_cache_backend())
+
+def invalidate_cached_responses(events):
+    """Called with the events of a committed transaction; drops responses they make stale."""
+    writes = [data for event_type, data in events if event_type in ("ticket", "payment")]
+    if not writes:
+        return
+    response_cache.invalidate("live")
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    for data in writes:
+        moment = data.get("entry_time") or data.get("transaction_time")
+        if moment is not None and to_naive_utc(moment) < today:
+            response_cache.invalidate("history")
+            break
+
+def cached_response(key: str, ttl_seconds: float, build, model):
+    """Serves `model` built by build() from the response cache, validating it once when it is filled."""
+    body = response_cache.get_or_set(key, ttl_seconds, lambda: model.model_validate(build()).model_dump_json())
+    return Response(content=body, media_type="application/json")
+
+# --- Keyset Pagination ---
+def encode_ticket_cursor(entry_time: datetime, ticket_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{entry_time.isoformat()}|{ticket_id}".encode()).decode()
+
+def decode_ticket_cursor(cursor: str):
+    try:
+        entry_time, ticket_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(entry_time), int(ticket_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 # --- Authentication and Authorization ---
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> SystemUser:
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def decode_access_token(token: str) -> TokenData:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with timed_stage("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+            raise credentials_exception()
+        return TokenData(
+            username=username, role=payload.get("role"), user_id=payload.get("uid"), principals_generation=payload.get("pgen")
+        )
     except JWTError:
-        raise credentials_exception
-    user = db.query(SystemUser).filter(SystemUser.username == token_data.username).first()
+        raise credentials_exception()
+
+def load_principal(username: str) -> CurrentUser:
+    # Read before the lookup, so a change committed meanwhile is not cached under the new generation
+    generation = response_cache.generation("principals")
+    principal = principal_cache.get(username, generation)
+    if principal is not None:
+        return principal
+    # Only a cache miss needs a database session
+    db = SessionLocal()
+    try:
+        with timed_stage("principal_lookup"):
+            user = db.query(SystemUser).filter(SystemUser.username == username).first()
+    finally:
+        db.close()
     if user is None:
-        raise credentials_exception
-    return user
-
-async def get_current_admin_user(current_user: SystemUser = Depends(get_current_user)) -> SystemUser:
+        raise credentials_exception()
+    principal = CurrentUser(user_id=user.user_id, username=user.username, role=user.role)
+    principal_cache.put(principal, generation)
+    return principal
+
+def get_current_user(token: str = Depends(oauth2_scheme)) -> CurrentUser:
+    return load_principal(decode_access_token(token).username)
+
+def get_current_admin_user(token: str = Depends(oauth2_scheme)) -> CurrentUser:
+    return require_admin(token)
+
+def get_current_admin_user_from_query(token: str = Query(..., description="Access token (EventSource cannot send headers)")) -> CurrentUser:
+    return require_admin(token)
+
+def trusts_role_claim(token_data: TokenData) -> bool:
+    """The signed role stands only while no user has been changed or deleted since the token was issued."""
+    if not (TRUST_TOKEN_ROLE_CLAIM and token_data.role and response_cache.backend.shared):
+        return False
+    generation = response_cache.generation("principals")
+    return generation is not None and generation == token_data.principals_generation
+
+def require_admin(token: str) -> CurrentUser:
+    token_data = decode_access_token(token)
+    if trusts_role_claim(token_data):
+        current_user = CurrentUser(user_id=token_data.user_id, username=token_data.username, role=token_data.role)
+    else:
+        current_user = load_principal(token_data.username)
     if current_user.role != "Administrator":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -369,14 +2327,29 @@ async def get_current_admin_user(current_user: SystemUser = Depends(get_current_
 
 
 # --- API Endpoints ---
+# Endpoints that use the (blocking) SQLAlchemy Session are plain `def`, so FastAPI runs
+# them on its threadpool instead of stalling the event loop on every DB round-trip.
 
 # Authentication Router
 auth_router = FastAPI().router
 
+def find_login_user(username: str) -> Optional[SystemUser]:
+    """
+    Looks the user up in a session of its own, closed before bcrypt runs, so logins waiting
+    for a password worker hold no database connection.
+    """
+    db = SessionLocal()
+    try:
+        return db.query(SystemUser).filter(SystemUser.username == username).first()
+    finally:
+        db.close()
+
 @auth_router.post("/auth/login", response_model=AuthResponse)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(SystemUser).filter(SystemUser.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.password_hash):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    # Read before the lookup, so a change committed meanwhile invalidates the role claim
+    principals_generation = await run_in_threadpool(response_cache.generation, "principals")
+    user = await run_in_threadpool(find_login_user, form_data.username)
+    if not user or not await verify_password_async(form_data.password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -385,7 +2358,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     expire_time = datetime.utcnow() + access_token_expires
     access_token = create_access_token(
-        data={"sub": user.username, "role": user.role},
+        data={"sub": user.username, "role": user.role, "uid": user.user_id, "pgen": principals_generation},
         expires_delta=access_token_expires
     )
     return {
@@ -398,23 +2371,23 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 entry_router = FastAPI().router
 
 @entry_router.get("/entry/config", response_model=EntryConfigResponse)
-async def get_entry_config():
-    return {
-        "fee_structure_details": {
-            "Motorcycle": {"first_hour": 10.0, "subsequent_hour": 5.0, "lost_ticket_penalty": 100.0},
-            "Compact": {"first_hour": 25.0, "subsequent_hour": 12.0, "lost_ticket_penalty": 250.0},
-            "Large": {"first_hour": 50.0, "subsequent_hour": 25.0, "lost_ticket_penalty": 500.0}
-        },
-        "supported_vehicle_types": ["Motorcycle", "Compact", "Large"]
+async def get_entry_config(request: Request):
+    tariffs = tariff_engine.current()
+    headers = {
+        "Cache-Control": f"public, max-age={ENTRY_CONFIG_MAX_AGE_SECONDS}",
+        "ETag": tariffs.entry_config_etag,
     }
+    if tariffs.entry_config_etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return ORJSONResponse(tariffs.entry_config, headers=headers)
 VALID_STATE_CODES = {
     "AN", "AP", "AR", "AS", "BR", "CH", "CG", "DD", "DL", "GA", "GJ", "HR",
     "HP", "JK", "JH", "KA", "KL", "LA", "LD", "MP", "MH", "MN", "ML", "MZ",
     "NL", "OD", "PY", "PB", "RJ", "SK", "TN", "TS", "TR", "UP", "UK", "WB"
 }
-@entry_router.post("/entry/ticket", response_model=EntryTicketResponse, status_code=status.HTTP_201_CREATED)
-async def create_ticket(request: EntryTicketRequest, db: Session = Depends(get_db)):
-    vehicle_number = request.vehicle_number.strip().upper()
+def validate_entry(vehicle_number: str, vehicle_type: str):
+    """Returns the normalized plate and the spot size the vehicle needs."""
+    vehicle_number = normalize_plate(vehicle_number)
     if len(vehicle_number) < 2 or vehicle_number[:2] not in VALID_STATE_CODES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -422,52 +2395,86 @@ async def create_ticket(request: EntryTicketRequest, db: Session = Depends(get_d
         )
     # Map vehicle type to spot size
     size_map = {"Motorcycle": "Motorcycle", "Compact": "Compact", "Large": "Large"}
-    required_size = size_map.get(request.vehicle_type)
+    required_size = size_map.get(vehicle_type)
     if not required_size:
         raise HTTPException(status_code=400, detail="Unsupported vehicle type")
+    return vehicle_number, required_size
 
-    # Find an available spot
-    available_spot = db.query(ParkingSpot).filter(
-        ParkingSpot.spot_size == required_size,
-        ParkingSpot.status == 'available'
-    ).first()
+@entry_router.post("/entry/ticket", response_model=EntryTicketResponse, status_code=status.HTTP_201_CREATED)
+def create_ticket(
+    request: EntryTicketRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=100)
+):
+    with shard_session_scope(shard_router.shard_for_lot(request.lot_id)) as db:
+        return issue_ticket(db, request, idempotency_key)
+
+def issue_ticket(db: Session, request: EntryTicketRequest, idempotency_key: Optional[str]):
+    # A retry of an entry that already went through gets the original ticket back
+    replay = idempotent_replay(db, idempotency_key, "entry")
+    if replay:
+        return replay
+    vehicle_number, required_size = validate_entry(request.vehicle_number, request.vehicle_type)
+    if plates_parked_elsewhere(db.info.get("shard", 0), [vehicle_number]):
+        raise HTTPException(status_code=409, detail=f"Vehicle {vehicle_number} is already parked.")
+
+    # Claim an available spot
+    available_spot = claim_spot(db, required_size)
 
     if not available_spot:
         raise HTTPException(status_code=404, detail=f"No available spots for vehicle type: {request.vehicle_type}")
 
-    # Get or create vehicle
-    vehicle = db.query(Vehicle).filter(Vehicle.vehicle_number == request.vehicle_number).first()
-    if not vehicle:
-        vehicle = Vehicle(vehicle_number=request.vehicle_number, vehicle_type=request.vehicle_type)
-        db.add(vehicle)
+    try:
+        vehicle = get_or_create_vehicle(db, vehicle_number, request.vehicle_type)
+        existing_active_ticket = db.query(Ticket).filter(
+            Ticket.vehicle_id == vehicle.vehicle_id,
+            Ticket.status == 'active'
+        ).first()
+
+        if existing_active_ticket:
+            raise HTTPException(status_code=409, detail=f"Vehicle {vehicle_number} is already parked.")
+        # Create ticket; the spot was already marked occupied by the claim
+        new_ticket = Ticket(vehicle_id=vehicle.vehicle_id, spot_id=available_spot.spot_id)
+        db.add(new_ticket)
         db.flush()
-    existing_active_ticket = db.query(Ticket).filter(
-        Ticket.vehicle_id == vehicle.vehicle_id,
-        Ticket.status == 'active'
-    ).first()
-
-    if existing_active_ticket:
-        raise HTTPException(status_code=409, detail=f"Vehicle {request.vehicle_number} is already parked.")
-    # Create ticket and update spot status
-    new_ticket = Ticket(vehicle_id=vehicle.vehicle_id, spot_id=available_spot.spot_id)
-    available_spot.status = 'occupied'
-    db.add(new_ticket)
-    db.commit()
-    db.refresh(new_ticket)
+        record_entry_rollup(db, new_ticket, available_spot, vehicle)
+        queue_event(db, "ticket", {
+            "ticket_id": new_ticket.ticket_id,
+            "vehicle_number": vehicle.vehicle_number,
+            "vehicle_type": vehicle.vehicle_type,
+            "lot_id": available_spot.lot_id,
+            "spot_number": available_spot.spot_number,
+            "entry_time": new_ticket.entry_time,
+        })
+        response = {
+            "ticket_id": new_ticket.ticket_id,
+            "spot_id": available_spot.spot_id,
+            "spot_number": available_spot.spot_number,
+            "entry_time": new_ticket.entry_time,
+            "qr_code_data": str(new_ticket.ticket_id)
+        }
+        recorded = idempotency_key and idempotency_store.record(db, idempotency_key, "entry", 201, response)
+        db.commit()
+    except Exception as e:
+        # Nothing was committed, so the spot goes back on its free-list
+        db.rollback()
+        allocator_for(db).release(available_spot.spot_id)
+        if idempotency_key and isinstance(e, IntegrityError):
+            # A concurrent retry with the same key committed first
+            replay = idempotent_replay(db, idempotency_key, "entry")
+            if replay:
+                return replay
+        raise
+    publish_queued_events(db)
+    if recorded:
+        idempotency_store.remember(recorded)
 
-    return {
-        "ticket_id": new_ticket.ticket_id,
-        "spot_id": available_spot.spot_id,
-        "spot_number": available_spot.spot_number,
-        "entry_time": new_ticket.entry_time,
-        "qr_code_data": str(new_ticket.ticket_id)
-    }
+    return response
 
 # Exit Terminal Router
 exit_router = FastAPI().router
 
 @exit_router.get("/exit/details/{ticket_id}", response_model=ExitDetailsResponse)
-async def get_exit_details(ticket_id: int, db: Session = Depends(get_db)):
+def get_exit_details(ticket_id: int, db: Session = Depends(get_ticket_db)):
     ticket = db.query(Ticket).filter(Ticket.ticket_id == ticket_id).first()
     if not ticket or ticket.status != 'active':
         raise HTTPException(status_code=404, detail="Active ticket not found")
@@ -475,7 +2482,7 @@ async def get_exit_details(ticket_id: int, db: Session = Depends(get_db)):
     current_time = datetime.utcnow()
     duration = current_time - ticket.entry_time
     duration_minutes = int(duration.total_seconds() / 60)
-    fee = calculate_fee(duration_minutes, ticket.vehicle.vehicle_type)
+    fee = calculate_fee(duration_minutes, ticket.vehicle.vehicle_type, ticket.entry_time)
 
     return {
         "ticket_id": ticket.ticket_id,
@@ -487,7 +2494,18 @@ async def get_exit_details(ticket_id: int, db: Session = Depends(get_db)):
     }
 
 @exit_router.post("/exit/payment", response_model=ExitPaymentResponse)
-async def process_payment(request: ExitPaymentRequest, db: Session = Depends(get_db)):
+def process_payment(
+    request: ExitPaymentRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=100)
+):
+    with shard_session_scope(shard_router.shard_for_ticket(request.ticket_id)) as db:
+        return pay_ticket(db, request, idempotency_key)
+
+def pay_ticket(db: Session, request: ExitPaymentRequest, idempotency_key: Optional[str]):
+    # A retry of a payment that already went through gets the original receipt, not a second Payment
+    replay = idempotent_replay(db, idempotency_key, "exit")
+    if replay:
+        return replay
     ticket = db.query(Ticket).filter(Ticket.ticket_id == request.ticket_id).first()
     if not ticket or ticket.status != 'active':
         raise HTTPException(status_code=404, detail="Active ticket not found")
@@ -496,7 +2514,7 @@ async def process_payment(request: ExitPaymentRequest, db: Session = Depends(get
     duration = current_time - ticket.entry_time
     duration_minutes = int(duration.total_seconds() / 60)
     vehicle_type = ticket.vehicle.vehicle_type
-    fee = calculate_fee(duration_minutes, vehicle_type)
+    fee = calculate_fee(duration_minutes, vehicle_type, ticket.entry_time)
 
     if request.amount_paid < fee:
         raise HTTPException(status_code=400, detail=f"Insufficient payment. Required: {fee}, Paid: {request.amount_paid}")
@@ -514,71 +2532,305 @@ async def process_payment(request: ExitPaymentRequest, db: Session = Depends(get
     # Update ticket and spot
     ticket.exit_time = current_time
     ticket.status = 'paid'
-    spot = db.query(ParkingSpot).filter(ParkingSpot.spot_id == ticket.spot_id).first()
+    spot = free_spot(db, ticket.spot_id)
+    try:
+        db.flush()
+        record_exit_rollups(db, payment, ticket)
+        queue_payment_event(db, payment, ticket)
+        response = {
+            "payment_id": payment.payment_id,
+            "payment_status": payment.payment_status,
+            "transaction_time": payment.transaction_time,
+            "message": "Payment successful. Thank you!"
+        }
+        recorded = idempotency_key and idempotency_store.record(db, idempotency_key, "exit", 200, response)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # A concurrent retry with the same key paid this ticket first
+        replay = idempotent_replay(db, idempotency_key, "exit")
+        if replay:
+            return replay
+        raise
+    publish_queued_events(db)
     if spot:
-        spot.status = 'available'
+        allocator_for(db).release(spot.spot_id)
+    if recorded:
+        idempotency_store.remember(recorded)
 
-    db.commit()
-    db.refresh(payment)
+    return response
 
+# Gate Sync Router
+gate_router = FastAPI().router
+
+def load_gate_vehicles(db: Session, vehicle_types: Dict[str, str], plates: set) -> Dict[str, Vehicle]:
+    """Vehicles by plate for a batch; plates in `vehicle_types` are registered if they are new."""
+    if vehicle_types:
+        rows = [{"vehicle_number": plate, "vehicle_type": vehicle_type} for plate, vehicle_type in vehicle_types.items()]
+        dialect = db.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            stmt = (pg_insert if dialect == "postgresql" else sqlite_insert)(Vehicle) \
+                .on_conflict_do_nothing(index_elements=["vehicle_number"])
+            db.execute(stmt, rows)
+        else:
+            known = set(db.execute(select(Vehicle.vehicle_number).where(Vehicle.vehicle_number.in_(vehicle_types))).scalars())
+            new_rows = [row for row in rows if row["vehicle_number"] not in known]
+            if new_rows:
+                db.execute(insert(Vehicle), new_rows)
+    plates = plates | set(vehicle_types)
+    if not plates:
+        return {}
+    return {vehicle.vehicle_number: vehicle for vehicle in db.query(Vehicle).filter(Vehicle.vehicle_number.in_(plates))}
+
+def apply_gate_events(db: Session, events: List[GateEvent], claimed: List[int], freed: List[int]):
+    """
+    Applies a replayed batch in event time order without committing and returns the results
+    in request order. Spots taken and given back are appended to `claimed` and `freed`.
+    """
+    keys = {gate_event.idempotency_key for gate_event in events}
+    # Same rules as IdempotencyStore.lookup: expired keys are unused, and a key applied by another
+    # endpoint is rejected for that event alone
+    cutoff = datetime.utcnow() - timedelta(seconds=idempotency_store.ttl_seconds)
+    applied_before, expired, results = {}, [], {}
+    for row in db.query(IdempotencyKey).filter(IdempotencyKey.key.in_(keys)):
+        if row.created_at < cutoff:
+            expired.append(row.key)
+        elif row.scope != "gate-events":
+            results[row.key] = GateEventResult(
+                idempotency_key=row.key, status_code=422, detail="Idempotency-Key was already used for a different request"
+            )
+        else:
+            applied_before[row.key] = row
+    if expired:
+        # Not pruned yet; make room for the events that reuse them
+        db.query(IdempotencyKey).filter(IdempotencyKey.key.in_(expired)).delete(synchronize_session=False)
+
+    # Everything the events refer to is loaded up front in a handful of queries
+    vehicle_types, plates = {}, set()
+    for gate_event in events:
+        if gate_event.idempotency_key in applied_before or gate_event.idempotency_key in results or not gate_event.vehicle_number:
+            continue
+        if gate_event.type == "entry":
+            try:
+                plate, _ = validate_entry(gate_event.vehicle_number, gate_event.vehicle_type or "")
+            except HTTPException:
+                continue
+            vehicle_types.setdefault(plate, gate_event.vehicle_type)
+        else:
+            plates.add(normalize_plate(gate_event.vehicle_number))
+    vehicles = load_gate_vehicles(db, vehicle_types, plates)
+    parked_elsewhere = plates_parked_elsewhere(db.info.get("shard", 0), vehicle_types)
+    ticket_ids = {gate_event.ticket_id for gate_event in events if gate_event.type == "exit" and gate_event.ticket_id}
+    known_tickets = db.query(Ticket).options(joinedload(Ticket.vehicle), joinedload(Ticket.spot)).filter(or_(
+        and_(Ticket.vehicle_id.in_([vehicle.vehicle_id for vehicle in vehicles.values()]), Ticket.status == 'active'),
+        Ticket.ticket_id.in_(ticket_ids)
+    )).all() if vehicles or ticket_ids else []
+    tickets_by_id = {ticket.ticket_id: ticket for ticket in known_tickets}
+    active_by_vehicle = {ticket.vehicle_id: ticket for ticket in known_tickets if ticket.status == 'active'}
+
+    entries, exits = [], []
+    rollups = RollupBuffer()
+    latest_allowed = datetime.utcnow() + timedelta(minutes=5)  # tolerated gate clock drift
+    for position, gate_event in sorted(enumerate(events), key=lambda item: to_naive_utc(item[1].occurred_at)):
+        key = gate_event.idempotency_key
+        if key in applied_before or key in results:
+            continue
+        occurred_at = to_naive_utc(gate_event.occurred_at)
+        try:
+            if occurred_at > latest_allowed:
+                raise HTTPException(status_code=400, detail="occurred_at is in the future")
+            if gate_event.type == "entry":
+                plate, required_size = validate_entry(gate_event.vehicle_number or "", gate_event.vehicle_type or "")
+                vehicle = vehicles[plate]
+                if vehicle.vehicle_id in active_by_vehicle or plate in parked_elsewhere:
+                    raise HTTPException(status_code=409, detail=f"Vehicle {plate} is already parked.")
+                spot = claim_spot(db, required_size)
+                if not spot:
+                    raise HTTPException(status_code=404, detail=f"No available spots for vehicle type: {gate_event.vehicle_type}")
+                claimed.append(spot.spot_id)
+                # Set now rather than at flush, so an exit later in the batch finds the ticket active
+                ticket = Ticket(vehicle=vehicle, spot=spot, entry_time=occurred_at, status='active')
+                db.add(ticket)
+                active_by_vehicle[vehicle.vehicle_id] = ticket
+                record_entry_rollup(db, ticket, spot, vehicle, upsert=rollups.add)
+                entries.append((key, ticket))
+            else:
+                if gate_event.ticket_id:
+                    ticket = tickets_by_id.get(gate_event.ticket_id)
+                else:
+                    vehicle = vehicles.get(normalize_plate(gate_event.vehicle_number or ""))
+                    ticket = active_by_vehicle.get(vehicle.vehicle_id) if vehicle else None
+                if not ticket or ticket.status != 'active':
+                    raise HTTPException(status_code=404, detail="Active ticket not found")
+                if occurred_at < ticket.entry_time:
+                    raise HTTPException(status_code=400, detail="Exit is earlier than the ticket's entry")
+                duration_minutes = int((occurred_at - ticket.entry_time).total_seconds() / 60)
+                fee = calculate_fee(duration_minutes, ticket.vehicle.vehicle_type, ticket.entry_time)
+                if gate_event.amount_paid is None or gate_event.amount_paid < fee:
+                    raise HTTPException(status_code=400, detail=f"Insufficient payment. Required: {fee}, Paid: {gate_event.amount_paid}")
+                payment = Payment(
+                    ticket=ticket,
+                    base_fee=fee,
+                    total_amount=gate_event.amount_paid,
+                    payment_method=gate_event.payment_method or "Cash",
+                    payment_status='successful',
+                    transaction_time=occurred_at
+                )
+                db.add(payment)
+                ticket.exit_time = occurred_at
+                ticket.status = 'paid'
+                active_by_vehicle.pop(ticket.vehicle.vehicle_id, None)
+                if free_spot(db, ticket.spot.spot_id):
+                    freed.append(ticket.spot.spot_id)
+                record_exit_rollups(db, payment, ticket, upsert=rollups.add)
+                exits.append((key, ticket, payment))
+        except HTTPException as e:
+            results[key] = GateEventResult(idempotency_key=key, status_code=e.status_code, detail=e.detail)
+        else:
+            results[key] = None  # filled in once the inserts have assigned ids
+
+    # One flush inserts every new ticket and payment and updates the exited tickets in batches
+    db.flush()
+    rollups.flush(db)
+    for key, ticket in entries:
+        results[key] = GateEventResult(
+            idempotency_key=key, status_code=201, ticket_id=ticket.ticket_id,
+            spot_id=ticket.spot.spot_id, spot_number=ticket.spot.spot_number
+        )
+        queue_event(db, "ticket", {
+            "ticket_id": ticket.ticket_id,
+            "vehicle_number": ticket.vehicle.vehicle_number,
+            "vehicle_type": ticket.vehicle.vehicle_type,
+            "lot_id": ticket.spot.lot_id,
+            "spot_number": ticket.spot.spot_number,
+            "entry_time": ticket.entry_time,
+        })
+    for key, ticket, payment in exits:
+        results[key] = GateEventResult(idempotency_key=key, status_code=200, ticket_id=ticket.ticket_id, payment_id=payment.payment_id)
+        queue_payment_event(db, payment, ticket)
+    # Only applied events are remembered; rejected ones can be retried
+    applied = [result for result in results.values() if result.status_code < 400]
+    if applied:
+        db.execute(insert(IdempotencyKey), [
+            {"key": result.idempotency_key, "scope": "gate-events", "status_code": result.status_code,
+             "response": result.model_dump_json()}
+            for result in applied
+        ])
+
+    ordered, reported = [], set()
+    for gate_event in events:
+        key = gate_event.idempotency_key
+        if key in applied_before:
+            ordered.append(GateEventResult.model_validate_json(applied_before[key].response).model_copy(update={"duplicate": True}))
+        elif key in reported and results[key].status_code < 400:
+            # A key repeated inside the batch reports the first event's result
+            ordered.append(results[key].model_copy(update={"duplicate": True}))
+        else:
+            ordered.append(results[key])
+            reported.add(key)
+    return ordered
+
+@gate_router.post("/gate/events", response_model=GateEventBatchResponse)
+def ingest_gate_events(batch: GateEventBatch):
+    with shard_session_scope(shard_router.shard_for_lot(batch.lot_id)) as db:
+        return apply_gate_batch(db, batch)
+
+def apply_gate_batch(db: Session, batch: GateEventBatch):
+    """Replays entries and exits buffered by an offline gate in one transaction."""
+    for attempt in range(2):
+        claimed, freed = [], []
+        try:
+            results = apply_gate_events(db, batch.events, claimed, freed)
+            db.commit()
+            break
+        except Exception as e:
+            # Nothing was committed, so the claimed spots go back on their free-lists
+            db.rollback()
+            for spot_id in claimed:
+                allocator_for(db).release(spot_id)
+            if not isinstance(e, IntegrityError):
+                raise
+            if attempt:
+                raise HTTPException(status_code=409, detail="Events were applied concurrently; retry the batch")
+            # Another request applied some of these keys first; the retry reports them as duplicates
+    publish_queued_events(db)
+    # Spots freed and then claimed again in the same batch stay occupied
+    for spot_id in set(freed) - set(claimed):
+        allocator_for(db).release(spot_id)
+    # Each event is counted once; a repeat of a rejected event was not applied either, so it is rejected too
     return {
-        "payment_id": payment.payment_id,
-        "payment_status": payment.payment_status,
-        "transaction_time": payment.transaction_time,
-        "message": "Payment successful. Thank you!"
+        "applied": sum(1 for result in results if result.status_code < 400 and not result.duplicate),
+        "duplicates": sum(1 for result in results if result.duplicate),
+        "rejected": sum(1 for result in results if result.status_code >= 400 and not result.duplicate),
+        "results": results,
     }
 
 # Admin Router
 admin_router = FastAPI().router
 
 @admin_router.get("/dashboard/summary", response_model=DashboardSummaryResponse, dependencies=[Depends(get_current_admin_user)])
-async def get_dashboard_summary(db: Session = Depends(get_db)):
-    total_spots = db.query(ParkingSpot).count()
-    occupied_spots = db.query(ParkingSpot).filter(ParkingSpot.status == 'occupied').count()
-    lot_breakdown_query = db.query(
-        ParkingLot.name, 
-        func.count(ParkingSpot.spot_id).label('total'),
-        func.sum(case((ParkingSpot.status == 'occupied', 1), else_=0)).label('occupied')
-    ).join(ParkingSpot).group_by(ParkingLot.name).all()
-    
-    breakdown_by_lot = {name: {"total": total, "occupied": occupied or 0} for name, total, occupied in lot_breakdown_query}
-    
-    size_breakdown_query = db.query(ParkingSpot.spot_size, func.count(ParkingSpot.spot_id)).group_by(ParkingSpot.spot_size).all()
-    breakdown_by_size = {size: count for size, count in size_breakdown_query}
-
-    return {
+def get_dashboard_summary():
+    # One small read of the live counters of every site instead of aggregating ParkingSpot
+    counters = [row for rows in shard_router.gather(lambda db: db.query(
+        ParkingLot.name, OccupancyCounter.spot_size, OccupancyCounter.total, OccupancyCounter.occupied
+    ).join(OccupancyCounter, ParkingLot.lot_id == OccupancyCounter.lot_id).all()) for row in rows]
+
+    total_spots = 0
+    occupied_spots = 0
+    breakdown_by_lot = {}
+    breakdown_by_size = {}
+    for lot_name, spot_size, total, occupied in counters:
+        total_spots += total
+        occupied_spots += occupied
+        lot = breakdown_by_lot.setdefault(lot_name, {"total": 0, "occupied": 0})
+        lot["total"] += total
+        lot["occupied"] += occupied
+        breakdown_by_size[spot_size] = breakdown_by_size.get(spot_size, 0) + total
+
+    return trusted_response({
         "total_spots": total_spots,
         "occupied_spots": occupied_spots,
         "available_spots": total_spots - occupied_spots,
         "breakdown_by_lot": breakdown_by_lot,
         "breakdown_by_size": breakdown_by_size
-    }
+    })
+
+def count_by_day(column, range_start: datetime, range_end: datetime) -> Dict[str, int]:
+    """Tickets per day over every site."""
+    # Filter on the raw timestamps so the entry_time/exit_time indexes can be used
+    counts = {}
+    for rows in shard_router.gather(lambda db: db.query(func.date(column), func.count(Ticket.ticket_id))
+                                    .filter(column >= range_start, column < range_end)
+                                    .group_by(func.date(column)).all(), replica=True):
+        for day, count in rows:
+            # PostgreSQL returns dates and SQLite strings; both print as YYYY-MM-DD
+            counts[str(day)] = counts.get(str(day), 0) + count
+    return counts
 
 # NEW: The trends endpoint for the charts
 @admin_router.get("/dashboard/trends", response_model=DashboardTrendsResponse, dependencies=[Depends(get_current_admin_user)])
-async def get_dashboard_trends(db: Session = Depends(get_db)):
+def get_dashboard_trends():
     try:
         today = datetime.utcnow().date()
         seven_days_ago = today - timedelta(days=6)
         date_range = [seven_days_ago + timedelta(days=i) for i in range(7)]
         
-        entries_query = db.query(
-            func.date(Ticket.entry_time).label('date'),
-            func.count(Ticket.ticket_id).label('count')
-        ).filter(
-            func.date(Ticket.entry_time).between(seven_days_ago, today)
-        ).group_by(func.date(Ticket.entry_time)).all()
-        
-        exits_query = db.query(
-            func.date(Ticket.exit_time).label('date'),
-            func.count(Ticket.ticket_id).label('count')
-        ).filter(
-            Ticket.exit_time.isnot(None),
-            func.date(Ticket.exit_time).between(seven_days_ago, today)
-        ).group_by(func.date(Ticket.exit_time)).all()
-
-        entries_dict = {entry.date: entry.count for entry in entries_query}
-        exits_dict = {exit.date: exit.count for exit in exits_query}
+        range_start = datetime.combine(seven_days_ago, datetime.min.time())
+        today_start = datetime.combine(today, datetime.min.time())
+        range_end = today_start + timedelta(days=1)
+
+        # Earlier days only change when an offline terminal is replayed, so only today is counted per request
+        history = json.loads(response_cache.get_or_set(
+            f"trends:{seven_days_ago.isoformat()}",
+            TRENDS_HISTORY_CACHE_TTL_SECONDS,
+            lambda: json.dumps({
+                "entries": count_by_day(Ticket.entry_time, range_start, today_start),
+                "exits": count_by_day(Ticket.exit_time, range_start, today_start),
+            }),
+            namespace="history"
+        ))
+        entries_dict = {**history["entries"], **count_by_day(Ticket.entry_time, today_start, range_end)}
+        exits_dict = {**history["exits"], **count_by_day(Ticket.exit_time, today_start, range_end)}
         
         labels = [d.strftime("%a") for d in date_range]
         entries_data = [entries_dict.get(d.isoformat(), 0) for d in date_range]
@@ -597,68 +2849,140 @@ async def get_dashboard_trends(db: Session = Depends(get_db)):
         )
 
 @admin_router.get("/parking-lots/{lot_id}/map", response_model=LotMapResponse, dependencies=[Depends(get_current_admin_user)])
-async def get_lot_map(lot_id: int, db: Session = Depends(get_db)):
+def get_lot_map(
+    lot_id: int,
+    request: Request,
+    response: Response,
+    since_version: Optional[int] = Query(None, description="Only return spots changed after this map version"),
+    encoding: str = Query("full", description="'full' spot list or 'bitmap' of statuses in map order"),
+    db: Session = Depends(get_lot_db)
+):
+    if encoding not in ("full", "bitmap"):
+        raise HTTPException(status_code=400, detail="encoding must be 'full' or 'bitmap'")
     lot = db.query(ParkingLot).filter(ParkingLot.lot_id == lot_id).first()
     if not lot:
         raise HTTPException(status_code=404, detail="Parking lot not found")
-    
-    spots = db.query(ParkingSpot).filter(ParkingSpot.lot_id == lot_id).order_by(ParkingSpot.spot_number).all()
-    
-    return {
-        "lot_id": lot.lot_id,
-        "lot_name": lot.name,
-        "spots_array": spots
-    }
 
+    etag = f'W/"lot-{lot.lot_id}-{lot.map_version}-{encoding}-{since_version}"'
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    # Natural order, so "A2" comes before "A10"
+    query = db.query(
+        ParkingSpot.spot_id, ParkingSpot.spot_number, ParkingSpot.status, ParkingSpot.spot_size
+    ).filter(ParkingSpot.lot_id == lot_id).order_by(func.length(ParkingSpot.spot_number), ParkingSpot.spot_number)
+
+    result = {
+        "lot_id": lot.lot_id, "lot_name": lot.name, "spots_array": [], "version": lot.map_version,
+        "changed_since": None, "status_bitmap": None, "spot_count": None,
+    }
+    if encoding == "bitmap":
+        statuses = [spot_status for (spot_status,) in query.with_entities(ParkingSpot.status).all()]
+        bitmap = bytearray((len(statuses) + 7) // 8)
+        for i, spot_status in enumerate(statuses):
+            if spot_status == 'occupied':
+                bitmap[i // 8] |= 0x80 >> (i % 8)
+        result["status_bitmap"] = base64.b64encode(bytes(bitmap)).decode()
+        result["spot_count"] = len(statuses)
+        return trusted_response(result, response)
+
+    if since_version is not None:
+        result["changed_since"] = since_version
+        if since_version >= lot.map_version:
+            return trusted_response(result, response)
+        query = query.filter(ParkingSpot.version > since_version)
+    result["spots_array"] = [
+        {"spot_id": spot_id, "spot_number": spot_number, "status": spot_status, "spot_size": spot_size}
+        for spot_id, spot_number, spot_status, spot_size in query.all()
+    ]
+    return trusted_response(result, response)
+
+
+def ticket_page(db: Session, status_filter: Optional[str], vehicle_number: Optional[str], spot_id: Optional[int],
+                sort_by: Optional[str], after, limit: int):
+    """Up to `limit` tickets of one shard after the keyset cursor, with their payment totals."""
+    # The joined rows populate the relationships, so reading them later fires no lazy loads
+    query = db.query(
+        Ticket, 
+        Payment.total_amount
+    ).outerjoin(Payment, Ticket.ticket_id == Payment.ticket_id) \
+     .join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id) \
+     .join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+     .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.lot_id) \
+     .options(contains_eager(Ticket.vehicle), contains_eager(Ticket.spot).contains_eager(ParkingSpot.lot))
+
+    if status_filter:
+        query = query.filter(Ticket.status == status_filter)
+    if vehicle_number:
+        query = query.filter(vehicle_number_filter(db, vehicle_number))
+    if spot_id:
+        query = query.filter(Ticket.spot_id == spot_id)
+
+    # Keyset pagination on (entry_time, ticket_id): each page starts where the last one ended
+    if sort_by == 'entry_time_asc':
+        if after:
+            query = query.filter(or_(
+                Ticket.entry_time > after[0],
+                and_(Ticket.entry_time == after[0], Ticket.ticket_id > after[1])
+            ))
+        query = query.order_by(Ticket.entry_time.asc(), Ticket.ticket_id.asc())
+    else:
+        if after:
+            query = query.filter(or_(
+                Ticket.entry_time < after[0],
+                and_(Ticket.entry_time == after[0], Ticket.ticket_id < after[1])
+            ))
+        query = query.order_by(Ticket.entry_time.desc(), Ticket.ticket_id.desc())
+    return query.limit(limit).all()
 
 # In main.py, REPLACE the entire get_tickets function with this one
 # In main.py, REPLACE the entire get_tickets function
 
 @admin_router.get("/tickets", response_model=List[TicketResponse], dependencies=[Depends(get_current_admin_user)])
-async def get_tickets(
+def get_tickets(
+    response: Response,
     status: Optional[str] = Query(None, description="Filter by status e.g., 'active', 'paid'"),
     vehicle_number: Optional[str] = Query(None, description="Filter by vehicle number"),
     spot_id: Optional[int] = Query(None, description="Filter by spot ID"),
     sort_by: Optional[str] = Query('entry_time_desc', description="Sort order e.g., 'entry_time_desc'"),
-    db: Session = Depends(get_db)
+    page_size: int = Query(100, ge=1, le=500, description="Tickets per page"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor header of the previous page"),
 ):
+    after = decode_ticket_cursor(cursor) if cursor else None
     try:
-        query = db.query(
-            Ticket, 
-            Payment.total_amount
-        ).outerjoin(Payment, Ticket.ticket_id == Payment.ticket_id) \
-         .join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id) \
-         .join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
-         .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.lot_id)
-
-        if status:
-            query = query.filter(Ticket.status == status)
-        if vehicle_number:
-            query = query.filter(Vehicle.vehicle_number.ilike(f"%{vehicle_number}%"))
-        if spot_id:
-            query = query.filter(Ticket.spot_id == spot_id)
-
-        if sort_by == 'entry_time_desc':
-            query = query.order_by(Ticket.entry_time.desc())
-        elif sort_by == 'entry_time_asc':
-            query = query.order_by(Ticket.entry_time.asc())
-
-        ticket_results = query.limit(100).all()
-        
-        response = []
+        ticket_results = [row for rows in shard_router.gather(
+            lambda db: ticket_page(db, status, vehicle_number, spot_id, sort_by, after, page_size + 1), replica=True
+        ) for row in rows]
+        if shard_router.sharded:
+            # Every shard sent its own next page; the merged page is the start of their union
+            ticket_results.sort(key=lambda row: (row[0].entry_time, row[0].ticket_id), reverse=sort_by != 'entry_time_asc')
+            ticket_results = ticket_results[:page_size + 1]
+
+        # One extra row tells us whether there is a next page
+        if len(ticket_results) > page_size:
+            ticket_results = ticket_results[:page_size]
+            last = ticket_results[-1][0]
+            response.headers["X-Next-Cursor"] = encode_ticket_cursor(last.entry_time, last.ticket_id)
+
+        tickets = []
         current_time = datetime.utcnow() # Get current time once for consistency
 
-        for t, db_total_amount in ticket_results:
-            final_amount = db_total_amount
+        # Active tickets are priced as of now, all in one pass
+        active = [t for t, _ in ticket_results if t.status == 'active']
+        current_fees = dict(zip(
+            (t.ticket_id for t in active),
+            calculate_fees(
+                [int((current_time - t.entry_time).total_seconds() / 60) for t in active],
+                [t.vehicle.vehicle_type for t in active],
+                [t.entry_time for t in active]
+            ).tolist()
+        )) if active else {}
 
-            # --- NEW LOGIC: If the ticket is active, calculate the current fee ---
-            if t.status == 'active':
-                duration = current_time - t.entry_time
-                duration_minutes = int(duration.total_seconds() / 60)
-                final_amount = calculate_fee(duration_minutes, t.vehicle.vehicle_type)
-            # --- END OF NEW LOGIC ---
+        for t, db_total_amount in ticket_results:
+            final_amount = current_fees.get(t.ticket_id, None if db_total_amount is None else float(db_total_amount))
 
-            response.append({
+            tickets.append({
                 "ticket_id": t.ticket_id,
                 "vehicle_number": t.vehicle.vehicle_number,
                 "vehicle_type": t.vehicle.vehicle_type,
@@ -669,19 +2993,65 @@ async def get_tickets(
                 "total_amount": final_amount, # Use either the DB amount or the newly calculated one
                 "status": t.status
             })
-        return response
+        return trusted_response(tickets, response)
 
     except Exception as e:
         print(f"An error occurred in get_tickets: {e}")
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            # The `status` query parameter shadows the fastapi.status module here
+            status_code=500,
             detail=f"An internal error occurred while fetching tickets: {str(e)}"
         )
 
+@admin_router.get("/vehicles/search", response_model=List[VehicleSearchResult], dependencies=[Depends(get_current_admin_user)])
+def search_vehicles(
+    q: str = Query(..., min_length=1, description="Any part of a vehicle number"),
+    limit: int = Query(10, ge=1, le=50)
+):
+    # No ORDER BY: sorting every match of a common fragment costs more than the lookup itself
+    vehicles = {}
+    for shard_vehicles in shard_router.gather(lambda db: db.query(Vehicle).filter(vehicle_number_filter(db, q)).limit(limit).all()):
+        for vehicle in shard_vehicles:
+            # A car that parked at several sites has a Vehicle row on each of their shards
+            vehicles.setdefault(vehicle.vehicle_number, vehicle)
+    return sorted(vehicles.values(), key=lambda vehicle: vehicle.vehicle_number)[:limit]
+
+@admin_router.get("/export/tickets", dependencies=[Depends(get_current_admin_user)])
+def export_tickets(
+    export_format: str = Query("csv", alias="format", pattern="^(csv|parquet)$"),
+    start_date: Optional[datetime] = Query(None, description="Tickets that entered at or after this time"),
+    end_date: Optional[datetime] = Query(None, description="Tickets that entered before this time"),
+    lot_id: Optional[int] = Query(None),
+    after_ticket_id: Optional[int] = Query(None, description="Resume after the last ticket_id received")
+):
+    stmt = export_statement(start_date, end_date, lot_id, after_ticket_id)
+    if export_format == "parquet":
+        if pq is None:
+            raise HTTPException(status_code=501, detail="Parquet export needs pyarrow installed on the server")
+        body, media_type = export_parquet(stmt), "application/vnd.apache.parquet"
+    else:
+        body, media_type = export_csv(stmt), "text/csv"
+    filename = f"tickets-after-{after_ticket_id or 0}.{export_format}"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 @admin_router.post("/exit/assisted", response_model=AssistedExitResponse, dependencies=[Depends(get_current_admin_user)])
-async def assisted_exit(request: AssistedExitRequest, db: Session = Depends(get_db)):
+def assisted_exit(request: AssistedExitRequest):
+    shard = 0
+    if shard_router.sharded:
+        plate = normalize_plate(request.vehicle_number)
+        # Only the plate is known, so ask every site which one has the car parked
+        holders = shard_router.gather(lambda db: db.query(Ticket.ticket_id).join(Vehicle).filter(
+            Vehicle.vehicle_number == plate, Ticket.status == 'active'
+        ).first())
+        ticket_ids = [row.ticket_id for row in holders if row is not None]
+        if ticket_ids:
+            shard = shard_router.shard_for_ticket(ticket_ids[0])
+    with shard_session_scope(shard) as db:
+        return process_assisted_exit(db, request)
+
+def process_assisted_exit(db: Session, request: AssistedExitRequest):
     ticket = db.query(Ticket).join(Vehicle).filter(
-        Vehicle.vehicle_number == request.vehicle_number,
+        Vehicle.vehicle_number == normalize_plate(request.vehicle_number),
         Ticket.status == 'active'
     ).first()
 
@@ -700,7 +3070,7 @@ async def assisted_exit(request: AssistedExitRequest, db: Session = Depends(get_
     if ticket:
         duration = current_time - ticket.entry_time
         duration_minutes = int(duration.total_seconds() / 60)
-        base_fee = calculate_fee(duration_minutes,vehicle_type)
+        base_fee = calculate_fee(duration_minutes, vehicle_type, ticket.entry_time)
 
     if request.exit_reason == 'LOST_TICKET':
         penalty_type_str = f"LOST_TICKET_{vehicle_type.upper()}"
@@ -725,13 +3095,19 @@ async def assisted_exit(request: AssistedExitRequest, db: Session = Depends(get_
     )
     db.add(payment)
     
+    spot = None
     if ticket:
         ticket.exit_time = current_time
         ticket.status = 'paid'
-        spot = db.query(ParkingSpot).filter(ParkingSpot.spot_id == ticket.spot_id).first()
-        if spot: spot.status = 'available'
+        spot = free_spot(db, ticket.spot_id)
+    db.flush()
+    record_exit_rollups(db, payment, ticket)
+    queue_payment_event(db, payment, ticket)
 
     db.commit()
+    publish_queued_events(db)
+    if spot:
+        allocator_for(db).release(spot.spot_id)
     db.refresh(payment)
 
     return {
@@ -743,84 +3119,166 @@ async def assisted_exit(request: AssistedExitRequest, db: Session = Depends(get_
         "message": "Assisted exit processed successfully."
     }
 @admin_router.get("/reports/revenue", response_model=RevenueReportResponse, dependencies=[Depends(get_current_admin_user)])
-async def get_revenue_report(
+def get_revenue_report(
     start_date: datetime, 
-    end_date: datetime, 
-    db: Session = Depends(get_db)
+    end_date: datetime
 ):
-    payments_query = db.query(Payment).filter(Payment.transaction_time.between(start_date, end_date))
-    total_transactions = payments_query.count()
-    total_revenue = payments_query.with_entities(func.sum(Payment.total_amount)).scalar() or 0
-    average_ticket = (total_revenue / total_transactions) if total_transactions > 0 else 0.0
+    return cached_response(
+        f"reports:revenue:{start_date.isoformat()}:{end_date.isoformat()}", REPORT_CACHE_TTL_SECONDS,
+        lambda: build_revenue_report(start_date, end_date), RevenueReportResponse
+    )
 
-    revenue_by_method = db.query(
+def revenue_report_rows(db: Session, start_date: datetime, end_date: datetime):
+    """Revenue of one shard grouped by lot and payment method, plus the names of its lots."""
+    first_hour, last_hour = split_report_range(start_date, end_date)
+    rows = []
+    if first_hour is not None:
+        rows += db.query(
+            RevenueRollup.lot_id,
+            RevenueRollup.payment_method,
+            func.sum(RevenueRollup.transactions),
+            func.sum(RevenueRollup.total_amount),
+            func.sum(RevenueRollup.base_fee),
+            func.sum(RevenueRollup.penalty_amount)
+        ).filter(RevenueRollup.bucket_start >= first_hour, RevenueRollup.bucket_start < last_hour) \
+         .group_by(RevenueRollup.lot_id, RevenueRollup.payment_method).all()
+
+    raw_lot_id = func.coalesce(ParkingSpot.lot_id, 0)
+    rows += db.query(
+        raw_lot_id,
         Payment.payment_method,
-        func.sum(Payment.total_amount)
-    ).filter(Payment.transaction_time.between(start_date, end_date)).group_by(Payment.payment_method).all()
-
-    revenue_by_lot = db.query(
-        ParkingLot.name,
-        func.sum(Payment.base_fee)
-    ).join(Ticket).join(ParkingSpot).join(ParkingLot).filter(Payment.transaction_time.between(start_date, end_date)).group_by(ParkingLot.name).all()
-
-    revenue_from_penalties = db.query(func.sum(Penalty.amount)).join(Payment).filter(
-        Payment.transaction_time.between(start_date, end_date),
-        Payment.penalty_id.isnot(None)
-    ).scalar() or 0
+        func.count(Payment.payment_id),
+        func.sum(Payment.total_amount),
+        func.sum(Payment.base_fee),
+        func.sum(Penalty.amount)
+    ).select_from(Payment) \
+     .outerjoin(Penalty, Payment.penalty_id == Penalty.penalty_id) \
+     .outerjoin(Ticket, Payment.ticket_id == Ticket.ticket_id) \
+     .outerjoin(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
+     .filter(raw_edges_filter(Payment.transaction_time, start_date, end_date, first_hour, last_hour)) \
+     .group_by(raw_lot_id, Payment.payment_method).all()
+    return rows, dict(db.query(ParkingLot.lot_id, ParkingLot.name).all())
+
+def build_revenue_report(start_date: datetime, end_date: datetime) -> dict:
+    rows = []
+    lot_names = {}
+    for shard_rows, shard_lot_names in shard_router.gather(lambda db: revenue_report_rows(db, start_date, end_date), replica=True):
+        rows += shard_rows
+        lot_names.update(shard_lot_names)
+    total_transactions = 0
+    total_revenue = 0.0
+    revenue_from_penalties = 0.0
+    revenue_by_method = {}
+    revenue_by_lot = {}
+    for lot_id, payment_method, transactions, total_amount, base_fee, penalty_amount in rows:
+        total_transactions += transactions
+        total_revenue += float(total_amount or 0)
+        revenue_from_penalties += float(penalty_amount or 0)
+        revenue_by_method[payment_method] = revenue_by_method.get(payment_method, 0.0) + float(total_amount or 0)
+        if lot_id in lot_names:
+            name = lot_names[lot_id]
+            revenue_by_lot[name] = revenue_by_lot.get(name, 0.0) + float(base_fee or 0)
+    average_ticket = (total_revenue / total_transactions) if total_transactions > 0 else 0.0
 
     return {
         "report_period": {"start_date": start_date, "end_date": end_date},
         "total_revenue": total_revenue,
         "total_transactions": total_transactions, # Add to response
         "average_ticket": average_ticket, 
-        "revenue_by_payment_method": dict(revenue_by_method),
-        "revenue_by_lot": dict(revenue_by_lot),
+        "revenue_by_payment_method": revenue_by_method,
+        "revenue_by_lot": revenue_by_lot,
         "revenue_from_penalties": revenue_from_penalties
     }
 
 @admin_router.get("/reports/occupancy", response_model=OccupancyReportResponse, dependencies=[Depends(get_current_admin_user)], tags=["Administration"])
-async def get_occupancy_report(
+def get_occupancy_report(
     start_date: datetime, 
     end_date: datetime, 
-    db: Session = Depends(get_db)
+    resolution_minutes: int = Query(60, ge=5, le=1440, description="Bucket size of the occupancy curves"),
+    include_curves: bool = Query(False, description="Include per-lot occupancy curves"),
 ):
-    peak_hours_query = db.query(
-        extract('hour', Ticket.entry_time).label('hour'),
-        func.count(Ticket.ticket_id).label('count')
-    ).filter(Ticket.entry_time.between(start_date, end_date)).group_by('hour').order_by('hour').all()
+    """
+    Peak hours and stay times come from the hourly rollups, but average and peak occupancy are
+    swept from the raw ticket stays overlapping the range, so the range may span at most
+    OCCUPANCY_SWEEP_MAX_DAYS (31 by default); longer ranges are rejected with 400.
+    """
+    if to_naive_utc(end_date) - to_naive_utc(start_date) > timedelta(days=OCCUPANCY_SWEEP_MAX_DAYS):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Occupancy reports cover at most {OCCUPANCY_SWEEP_MAX_DAYS} days; request a shorter range.",
+        )
+    return cached_response(
+        f"reports:occupancy:{start_date.isoformat()}:{end_date.isoformat()}:{resolution_minutes}:{include_curves}",
+        REPORT_CACHE_TTL_SECONDS,
+        lambda: build_occupancy_report(start_date, end_date, resolution_minutes, include_curves),
+        OccupancyReportResponse
+    )
 
-    if engine.dialect.name == "postgresql":
-        duration_calc = func.avg(extract('epoch', Ticket.exit_time) - extract('epoch', Ticket.entry_time)) / 60
+def occupancy_report_rows(db: Session, start_date: datetime, end_date: datetime):
+    """Entries, exits and stay time of one shard grouped by hour of day, lot and vehicle type."""
+    first_hour, last_hour = split_report_range(start_date, end_date)
+    rows = []
+    if first_hour is not None:
+        rollup_hour = extract('hour', OccupancyRollup.bucket_start)
+        rows += db.query(
+            rollup_hour,
+            OccupancyRollup.lot_id,
+            OccupancyRollup.vehicle_type,
+            func.sum(OccupancyRollup.entries),
+            func.sum(OccupancyRollup.exits),
+            func.sum(OccupancyRollup.stay_seconds)
+        ).filter(OccupancyRollup.bucket_start >= first_hour, OccupancyRollup.bucket_start < last_hour) \
+         .group_by(rollup_hour, OccupancyRollup.lot_id, OccupancyRollup.vehicle_type).all()
+
+    if db.get_bind().dialect.name == "postgresql":
+        stay_seconds = extract('epoch', Ticket.exit_time) - extract('epoch', Ticket.entry_time)
     else: # SQLite
-        duration_calc = func.avg(func.julianday(Ticket.exit_time) - func.julianday(Ticket.entry_time)) * 24 * 60
+        stay_seconds = (func.julianday(Ticket.exit_time) - func.julianday(Ticket.entry_time)) * 86400
 
-    avg_duration_query = db.query(
+    raw_hour = extract('hour', Ticket.entry_time)
+    rows += db.query(
+        raw_hour,
+        ParkingSpot.lot_id,
         Vehicle.vehicle_type,
-        duration_calc.label('avg_duration')
-    ).join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id).filter(
-        Ticket.exit_time.isnot(None),
-        Ticket.entry_time.between(start_date, end_date)
-    ).group_by(Vehicle.vehicle_type).all()
-    
-    # CORRECTED QUERY: We explicitly tell SQLAlchemy how to join the tables
-    occupancy_by_lot_raw = db.query(
-        ParkingLot.name, 
-        func.count(Ticket.ticket_id)
+        func.count(Ticket.ticket_id),
+        func.count(Ticket.exit_time),
+        func.sum(stay_seconds)
     ).join(ParkingSpot, Ticket.spot_id == ParkingSpot.spot_id) \
-     .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.lot_id) \
-     .filter(Ticket.entry_time.between(start_date, end_date)) \
-     .group_by(ParkingLot.name).all()
+     .join(Vehicle, Ticket.vehicle_id == Vehicle.vehicle_id) \
+     .filter(raw_edges_filter(Ticket.entry_time, start_date, end_date, first_hour, last_hour)) \
+     .group_by(raw_hour, ParkingSpot.lot_id, Vehicle.vehicle_type).all()
+    return rows
+
+def build_occupancy_report(start_date: datetime, end_date: datetime, resolution_minutes: int, include_curves: bool) -> dict:
+    rows = [row for rows in shard_router.gather(lambda db: occupancy_report_rows(db, start_date, end_date), replica=True) for row in rows]
+    peak_hours = {}
+    exits_by_type = {}
+    stay_by_type = {}
+    for hour, lot_id, vehicle_type, entries, exits, stay in rows:
+        peak_hours[int(hour)] = peak_hours.get(int(hour), 0) + entries
+        if exits:
+            exits_by_type[vehicle_type] = exits_by_type.get(vehicle_type, 0) + exits
+            stay_by_type[vehicle_type] = stay_by_type.get(vehicle_type, 0.0) + float(stay or 0)
+
+    occupancy, (average_occupancy, peak_occupancy, _) = compute_lot_occupancy(start_date, end_date, resolution_minutes)
 
     return {
         "report_period": {"start_date": start_date, "end_date": end_date},
-        "peak_hours_data": dict(peak_hours_query),
-        "occupancy_by_lot": dict(occupancy_by_lot_raw),
-        "average_duration_by_vehicle_type": dict(avg_duration_query)
+        "peak_hours_data": dict(sorted(peak_hours.items())),
+        "occupancy_by_lot": {name: average for name, (average, _, _) in occupancy.items()},
+        "average_duration_by_vehicle_type": {
+            vehicle_type: stay_by_type[vehicle_type] / exits / 60 for vehicle_type, exits in exits_by_type.items()
+        },
+        "peak_occupancy_by_lot": {name: peak for name, (_, peak, _) in occupancy.items()},
+        "average_occupancy": average_occupancy,
+        "peak_occupancy": peak_occupancy,
+        "resolution_minutes": resolution_minutes,
+        "occupancy_curve_by_lot": {name: curve for name, (_, _, curve) in occupancy.items()} if include_curves else None
     }
     
 contact_router = FastAPI().router
 @contact_router.post("/contact/submit", status_code=status.HTTP_201_CREATED)
-async def submit_contact_message(request: ContactMessageCreate, db: Session = Depends(get_db)):
+def submit_contact_message(request: ContactMessageCreate, db: Session = Depends(get_db)):
     new_message = ContactMessage(
         name=request.name,
         email=request.email,
@@ -831,12 +3289,88 @@ async def submit_contact_message(request: ContactMessageCreate, db: Session = De
     return {"message": "Your message has been received."}
 
 @admin_router.get("/messages", response_model=List[ContactMessageResponse], dependencies=[Depends(get_current_admin_user)])
-async def get_contact_messages(db: Session = Depends(get_db)):
+def get_contact_messages(db: Session = Depends(get_read_db)):
     messages = db.query(ContactMessage).order_by(ContactMessage.timestamp.desc()).limit(20).all()
     return messages
 
+@admin_router.get("/events/snapshot", response_model=EventSnapshotResponse, dependencies=[Depends(get_current_admin_user)])
+def get_event_snapshot():
+    # Read the sequence number first: events after it may already be in the counters,
+    # but they carry absolute values, so replaying them on top is harmless.
+    seq = event_broker.seq
+    lots = {}
+    counters = [row for rows in shard_router.gather(lambda db: db.query(
+        ParkingLot.lot_id, ParkingLot.name, OccupancyCounter.spot_size, OccupancyCounter.total, OccupancyCounter.occupied
+    ).join(OccupancyCounter, ParkingLot.lot_id == OccupancyCounter.lot_id).all()) for row in rows]
+    for lot_id, lot_name, spot_size, total, occupied in counters:
+        lot = lots.setdefault(lot_id, {"name": lot_name, "total": {}, "occupied": {}})
+        lot["total"][spot_size] = total
+        lot["occupied"][spot_size] = occupied
+    return {"seq": seq, "complete": event_broker.complete, "lots": lots}
+
+@admin_router.get("/events/stream", dependencies=[Depends(get_current_admin_user_from_query)])
+async def stream_events(request: Request, last_event_id: Optional[int] = Query(None)):
+    """
+    Server-sent events for the live dashboard: `spot`, `ticket` and `payment` deltas,
+    or `resync` when the client fell too far behind and must reload the snapshot.
+    Resumes after `last_event_id` (or the Last-Event-ID header sent on reconnect).
+    """
+    # The browser's automatic reconnect sends Last-Event-ID, which is newer than the query string
+    header_id = request.headers.get("last-event-id")
+    if header_id and header_id.isdigit():
+        last_event_id = int(header_id)
+    queue, replay = event_broker.subscribe(last_event_id)
+    # A client coming from a worker that had relayed further already has these
+    seen = last_event_id or 0
+
+    def encode(message):
+        seq, event_type, data = message
+        payload = json.dumps(data, separators=(",", ":"), default=str)
+        return f"id: {seq}\nevent: {event_type}\ndata: {payload}\n\n"
+
+    async def stream():
+        try:
+            for message in replay:
+                yield encode(message)
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message[0] <= seen and message[1] != "resync":
+                    continue
+                yield encode(message)
+        finally:
+            event_broker.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"X-Accel-Buffering": "no"})
+
+@admin_router.get("/db/pool", response_model=List[PoolStatusResponse], dependencies=[Depends(get_current_admin_user)])
+def get_pool_status():
+    statuses = []
+    for shard, replica, db_engine in shard_router.pools():
+        pool = db_engine.pool
+        wait_stats = shard_router.pool_wait_stats[db_engine]
+        def pool_metric(name):
+            metric = getattr(pool, name, None)
+            return metric() if callable(metric) else None
+        statuses.append({
+            "shard": shard,
+            "replica": replica,
+            "pool_class": type(pool).__name__,
+            "size": pool_metric("size"),
+            "checked_out": pool_metric("checkedout"),
+            "checked_in": pool_metric("checkedin"),
+            "overflow": pool_metric("overflow"),
+            "acquisitions": wait_stats.count,
+            "average_wait_ms": (wait_stats.total_seconds / wait_stats.count * 1000) if wait_stats.count else 0.0,
+            "max_wait_ms": wait_stats.max_seconds * 1000
+        })
+    return statuses
+
 @admin_router.delete("/messages/{message_id}", status_code=status.HTTP_200_OK, dependencies=[Depends(get_current_admin_user)])
-async def delete_contact_message(message_id: int, db: Session = Depends(get_db)):
+def delete_contact_message(message_id: int, db: Session = Depends(get_db)):
     message = db.query(ContactMessage).filter(ContactMessage.message_id == message_id).first()
     if not message:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found.")
@@ -846,54 +3380,65 @@ async def delete_contact_message(message_id: int, db: Session = Depends(get_db))
     return {"message": "Message deleted successfully."}
     
 # --- App Router Integration ---
+# Logins hold no connection while they wait for bcrypt, so they do not take a database slot
 app.include_router(auth_router, tags=["Authentication"])
-app.include_router(entry_router, tags=["Entry Terminal"])
-app.include_router(exit_router, tags=["Exit Terminal"])
-app.include_router(admin_router, prefix="/admin", tags=["Administration"])
-app.include_router(contact_router, tags=["Contact"])
+app.include_router(entry_router, tags=["Entry Terminal"], dependencies=[Depends(database_slot)])
+app.include_router(exit_router, tags=["Exit Terminal"], dependencies=[Depends(database_slot)])
+app.include_router(gate_router, tags=["Gate Sync"], dependencies=[Depends(database_slot)])
+app.include_router(admin_router, prefix="/admin", tags=["Administration"], dependencies=[Depends(database_slot)])
+app.include_router(contact_router, tags=["Contact"], dependencies=[Depends(database_slot)])
 
 # --- Application Startup Event ---
+@app.on_event("startup")
+async def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
-    print("--- Attempting to connect to the database... ---")
-    db = SessionLocal()
+    for shard, db_engine in shard_router.engines().items():
+        run_migrations(db_engine)
+        with db_engine.begin() as connection:
+            reserve_ticket_ids(connection, shard)
+        initialize_database(shard)
+    tariff_engine.current()  # a missing or broken tariff file should stop startup, not the first exit
+
+def initialize_database(shard: int):
+    print(f"--- Attempting to connect to the database of shard {shard}... ---")
+    db = shard_router.session(shard)
     try:
-        # Create users if they don't exist
+        # Create users if they don't exist; every shard has them so its payments can refer to them
         print("--- Database connection established successfully. Initializing data... ---")
         made_changes = False
         if not db.query(SystemUser).first():
-            db.add(SystemUser(username="admin", password_hash=get_password_hash("admin123"), role="Administrator"))
-            db.add(SystemUser(username="attendant1", password_hash=get_password_hash("attendant123"), role="Attendant"))
-            db.add(SystemUser(username="attendant2", password_hash=get_password_hash("attendant123"), role="Attendant"))
-            db.add(SystemUser(username="manager", password_hash=get_password_hash("manager123"), role="manager"))
-            db.add(SystemUser(username="records", password_hash=get_password_hash("records123"), role="records"))
+            seed_users = [
+                ("admin", "admin123", "Administrator"),
+                ("attendant1", "attendant123", "Attendant"),
+                ("attendant2", "attendant123", "Attendant"),
+                ("manager", "manager123", "manager"),
+                ("records", "records123", "records"),
+            ]
+            # Hash on the password pool in parallel rather than one after another
+            password_hashes = password_executor.map(get_password_hash, [password for _, password, _ in seed_users])
+            for (username, _, role), password_hash in zip(seed_users, password_hashes):
+                db.add(SystemUser(username=username, password_hash=password_hash, role=role))
+            made_changes = True
 
-        # Create lots and spots if they don't exist
+        # Create lots and spots if they don't exist; each default lot goes to the shard that owns it
         if not db.query(ParkingLot).first():
-            lot_a = ParkingLot(name="Main Lot A")
-            lot_b = ParkingLot(name="Overflow Lot B")
-            lot_c = ParkingLot(name="Economy Lot C")
-            db.add_all([lot_a, lot_b, lot_c])
-            db.flush() # This assigns the IDs to lot_a, lot_b, and lot_c
-
+            default_lots = [(1, "Main Lot A", "A"), (2, "Overflow Lot B", "B"), (3, "Economy Lot C", "C")]
             spots_to_add = []
-            # Add 100 spots to Lot A
-            for i in range(1, 41): spots_to_add.append(ParkingSpot(lot_id=lot_a.lot_id, spot_number=f"A{i}", spot_size="Motorcycle"))
-            for i in range(41, 71): spots_to_add.append(ParkingSpot(lot_id=lot_a.lot_id, spot_number=f"A{i}", spot_size="Compact"))
-            for i in range(71, 101): spots_to_add.append(ParkingSpot(lot_id=lot_a.lot_id, spot_number=f"A{i}", spot_size="Large"))
-            
-            # Add 30 spots to Lot B
-            for i in range(1, 41): spots_to_add.append(ParkingSpot(lot_id=lot_b.lot_id, spot_number=f"B{i}", spot_size="Motorcycle"))
-            for i in range(41, 71): spots_to_add.append(ParkingSpot(lot_id=lot_b.lot_id, spot_number=f"B{i}", spot_size="Compact"))
-            for i in range(71, 101): spots_to_add.append(ParkingSpot(lot_id=lot_b.lot_id, spot_number=f"B{i}", spot_size="Large"))
-            
-            # Add 30 spots to Lot C
-            for i in range(1, 41): spots_to_add.append(ParkingSpot(lot_id=lot_c.lot_id, spot_number=f"C{i}", spot_size="Motorcycle"))
-            for i in range(41, 71): spots_to_add.append(ParkingSpot(lot_id=lot_c.lot_id, spot_number=f"C{i}", spot_size="Compact"))
-            for i in range(71, 101): spots_to_add.append(ParkingSpot(lot_id=lot_c.lot_id, spot_number=f"C{i}", spot_size="Large"))
-            db.bulk_save_objects(spots_to_add)
-            made_changes = True
+            for lot_id, name, prefix in default_lots:
+                if shard_router.shard_for_lot(lot_id) != shard:
+                    continue
+                db.add(ParkingLot(lot_id=lot_id, name=name))
+                # 100 spots per lot: 40 Motorcycle, 30 Compact, 30 Large
+                for i in range(1, 41): spots_to_add.append(ParkingSpot(lot_id=lot_id, spot_number=f"{prefix}{i}", spot_size="Motorcycle"))
+                for i in range(41, 71): spots_to_add.append(ParkingSpot(lot_id=lot_id, spot_number=f"{prefix}{i}", spot_size="Compact"))
+                for i in range(71, 101): spots_to_add.append(ParkingSpot(lot_id=lot_id, spot_number=f"{prefix}{i}", spot_size="Large"))
+            if spots_to_add:
+                db.flush() # The lots must exist before their spots
+                db.bulk_save_objects(spots_to_add)
+                made_changes = True
 
         if not db.query(Penalty).first():
             db.add(Penalty(penalty_type="LOST_TICKET_MOTORCYCLE", amount=100.00))
@@ -905,13 +3450,81 @@ def on_startup():
             db.commit()
             print("--- Initial data committed to the database. ---")
 
+        reconcile_occupancy(db)
+        db.commit()
+        allocator_for(db).rebuild(db)
+
     finally:
         db.close()
 
+async def prune_idempotency_keys_periodically():
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            await run_in_threadpool(_prune_idempotency_keys_job)
+        except Exception as e:
+            print(f"An error occurred while pruning idempotency keys: {e}")
+
+def _prune_idempotency_keys_job():
+    def prune(db):
+        if idempotency_store.prune(db):
+            db.commit()
+    shard_router.gather(prune)
+
+async def reconcile_occupancy_periodically():
+    while True:
+        await asyncio.sleep(OCCUPANCY_RECONCILE_SECONDS)
+        try:
+            await run_in_threadpool(_reconcile_occupancy_job)
+        except Exception as e:
+            print(f"An error occurred while reconciling occupancy counters: {e}")
+
+def _reconcile_occupancy_job():
+    def reconcile(db):
+        if reconcile_occupancy(db):
+            db.commit()
+    shard_router.gather(reconcile)
+
+@app.on_event("startup")
+async def start_background_jobs():
+    shared_log = response_cache.backend if response_cache.backend.shared else None
+    event_broker.attach(asyncio.get_running_loop(), shared_log)
+    app.state.background_jobs = [
+        asyncio.create_task(reconcile_occupancy_periodically()),
+        asyncio.create_task(prune_idempotency_keys_periodically()),
+    ]
+    if shared_log is not None:
+        app.state.background_jobs.append(asyncio.create_task(event_broker.relay()))
+
 # --- Main Entry Point for Running the App ---
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    parser = argparse.ArgumentParser(description="Parking Lot Management API")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "backfill-rollups"],
+                        help="serve (default) runs the API; backfill-rollups rebuilds the report rollups")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY,
+                        help="Worker processes (default: WEB_CONCURRENCY or 1)")
+    parser.add_argument("--reload", action="store_true", help="Restart on code changes (development, single worker)")
+    args = parser.parse_args()
+    if args.command == "backfill-rollups":
+        for db_engine in shard_router.engines().values():
+            run_migrations(db_engine)
+            with db_engine.begin() as connection:
+                backfill_rollups(connection)
+    else:
+        if args.workers > 1:
+            if args.reload:
+                parser.error("--reload runs a single worker")
+            # Migrate and seed once here, so workers starting together on a fresh database do not race
+            on_startup()
+            if RATE_LIMIT_DEFAULT and RATE_LIMIT_STORAGE_URI.startswith("memory://"):
+                print("--- Rate limits are counted per worker; set RATE_LIMIT_STORAGE_URI to share them ---")
+            if RESPONSE_CACHE_BACKEND == "local":
+                print("--- Cached responses and dashboard events are per worker; "
+                      "set RESPONSE_CACHE_BACKEND=sqlite or redis to share them ---")
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)  # read by the workers
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, reload=args.reload)
 
 
 
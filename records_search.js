@@ -203,6 +203,26 @@ document.getElementById('searchForm').addEventListener('submit', (e) => {
     performSearch();
 });
 
+// Plate typeahead; other search modes take exact IDs
+const plateSuggestions = document.getElementById('plateSuggestions');
+let suggestTimer = null;
+document.getElementById('queryInput').addEventListener('input', (e) => {
+    clearTimeout(suggestTimer);
+    const fragment = e.target.value.trim();
+    if (document.getElementById('searchBy').value !== 'vehicle' || fragment.length < 2) {
+        plateSuggestions.innerHTML = '';
+        return;
+    }
+    suggestTimer = setTimeout(async () => {
+        try {
+            const vehicles = await fetchWithAuth(`/admin/vehicles/search?q=${encodeURIComponent(fragment)}&limit=10`);
+            plateSuggestions.innerHTML = vehicles.map(v => `<option value="${v.vehicle_number}"></option>`).join('');
+        } catch (error) {
+            console.error("Plate suggestions failed:", error);
+        }
+    }, 150);
+});
+
 document.getElementById('itemsPerPage').addEventListener('change', (e) => {
     state.perPage = parseInt(e.target.value, 10) || 6;
     state.page = 1;
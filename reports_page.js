@@ -312,8 +312,8 @@ function transformOccupancyData(apiData) {
         start: new Date(apiData.report_period.start_date),
         end: new Date(apiData.report_period.end_date),
         summary: {
-            avgOccupancy: 0, // Placeholder, as this requires more complex calculation
-            peakOccupancy: Math.max(...Object.values(apiData.peak_hours_data)), // Peak is the max count in any hour
+            avgOccupancy: apiData.average_occupancy, // Time-weighted % of all spots
+            peakOccupancy: apiData.peak_occupancy,
             lotsCount: Object.keys(apiData.occupancy_by_lot).length,
             daysCount: 7 // Assuming weekly
         },
@@ -0,0 +1,66 @@
+"""
+Shared fixtures: the app started once against a scratch SQLite database, with a few dozen
+tickets issued and some of them paid.
+
+Set TEST_DATABASE_URL to run against an empty Postgres database instead.
+"""
+import itertools
+import os
+import tempfile
+
+import pytest
+
+# main reads its configuration at import time
+os.environ["DATABASE_URL"] = os.environ.get(
+    "TEST_DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="parking-tests-"), "parkinglot.db")
+)
+os.environ["DATABASE_SHARDS"] = "[]"
+os.environ.pop("DATABASE_REPLICA_URL", None)
+os.environ["RESPONSE_CACHE_BACKEND"] = "local"
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+_plate_numbers = itertools.count(1)
+
+
+def next_plate(state="KA"):
+    """A valid plate no other test has used."""
+    n = next(_plate_numbers)
+    return f"{state}{n // 10000:02d}AB{n % 10000:04d}"
+
+
+def issue_ticket(client, vehicle_type="Compact"):
+    response = client.post("/entry/ticket", json={"vehicle_number": next_plate(), "vehicle_type": vehicle_type})
+    assert response.status_code == 201, response.text
+    return response.json()["ticket_id"]
+
+
+def pay_ticket(client, ticket_id):
+    fee = client.get(f"/exit/details/{ticket_id}").json()["calculated_fee"]
+    response = client.post("/exit/payment", json={"ticket_id": ticket_id, "amount_paid": fee, "payment_method": "Cash"})
+    assert response.status_code == 200, response.text
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    response = client.post("/auth/login", data={"username": "admin", "password": "admin123"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    # Loads the admin into the principal cache, so later requests only pay for their own queries
+    client.get("/admin/dashboard/summary", headers=headers).raise_for_status()
+    return headers
+
+
+@pytest.fixture(scope="session")
+def tickets(client):
+    """Ids of the tickets still parked; as many again have been paid."""
+    issued = [issue_ticket(client, vehicle_type) for vehicle_type in ["Compact", "Large", "Motorcycle"] * 20]
+    for ticket_id in issued[::2]:
+        pay_ticket(client, ticket_id)
+    return issued[1::2]
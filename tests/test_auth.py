@@ -0,0 +1,21 @@
+"""
+Role changes take effect on the next request, whatever the principal cache holds.
+"""
+import main
+
+
+def test_revoked_admin_is_denied_on_the_next_request(client):
+    with main.SessionLocal() as db:
+        db.add(main.SystemUser(username="revoked-admin", password_hash=main.get_password_hash("secret123"), role="Administrator"))
+        db.commit()
+    token = client.post("/auth/login", data={"username": "revoked-admin", "password": "secret123"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/admin/dashboard/summary", headers=headers).status_code == 200
+
+    with main.SessionLocal() as db:
+        db.query(main.SystemUser).filter_by(username="revoked-admin").one().role = "Attendant"
+        db.flush()
+        # A request between flush and commit still reads the committed admin row and caches it
+        assert client.get("/admin/dashboard/summary", headers=headers).status_code == 200
+        db.commit()
+    assert client.get("/admin/dashboard/summary", headers=headers).status_code == 403
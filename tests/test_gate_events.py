@@ -0,0 +1,28 @@
+"""
+Batches replayed by a gate that was offline, applied through /gate/events.
+"""
+from datetime import datetime, timedelta
+
+import main
+from conftest import next_plate
+
+
+def test_entry_and_exit_of_one_car_replay_in_one_batch(client):
+    plate, entered = next_plate(), datetime.utcnow() - timedelta(hours=2)
+    batch = {"events": [
+        {"idempotency_key": f"{plate}-in", "type": "entry", "occurred_at": entered.isoformat(),
+         "vehicle_number": plate, "vehicle_type": "Compact"},
+        {"idempotency_key": f"{plate}-out", "type": "exit", "occurred_at": (entered + timedelta(hours=1)).isoformat(),
+         "vehicle_number": plate, "amount_paid": 1000, "payment_method": "Cash"},
+    ]}
+    response = client.post("/gate/events", json=batch)
+    assert response.status_code == 200, response.text
+    entry, exit_ = response.json()["results"]
+    assert (entry["status_code"], exit_["status_code"]) == (201, 200), response.text
+    assert exit_["ticket_id"] == entry["ticket_id"]
+    assert response.json()["applied"] == 2
+
+    with main.SessionLocal() as db:
+        ticket = db.get(main.Ticket, entry["ticket_id"])
+        assert ticket.status == "paid"
+        assert ticket.payment.payment_id == exit_["payment_id"]
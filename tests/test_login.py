@@ -0,0 +1,45 @@
+"""
+A burst of logins waits for the bcrypt pool without holding database connections.
+"""
+import asyncio
+import threading
+
+import httpx
+
+import main
+
+STORM_SIZE = 16
+
+
+def test_login_storm_holds_no_connections_while_hashing(client, tickets, monkeypatch):
+    release = threading.Event()
+    verify = main.verify_password
+
+    def held_verify(plain_password, hashed_password):
+        release.wait(10)
+        return verify(plain_password, hashed_password)
+
+    monkeypatch.setattr(main, "verify_password", held_verify)
+
+    async def storm():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as storm_client:
+            logins = [
+                asyncio.create_task(storm_client.post("/auth/login", data={"username": "admin", "password": "admin123"}))
+                for _ in range(STORM_SIZE)
+            ]
+            while main._pending_password_checks < STORM_SIZE:
+                await asyncio.sleep(0.01)
+            # Every login has looked its user up and is waiting for bcrypt
+            checked_out = main.engine.pool.checkedout()
+            gate = await asyncio.to_thread(client.get, f"/exit/details/{tickets[0]}")
+            release.set()
+            return checked_out, gate, await asyncio.gather(*logins)
+
+    try:
+        checked_out, gate, responses = asyncio.run(asyncio.wait_for(storm(), 30))
+    finally:
+        release.set()
+    assert checked_out == 0
+    assert gate.status_code == 200, gate.text
+    assert all(response.status_code == 200 for response in responses)
@@ -0,0 +1,67 @@
+"""
+Statements per request, read from the query counter that every response reports in its
+Server-Timing header. Budgets assume the admin is already in the principal cache.
+"""
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+TICKET_PAGE_QUERY_BUDGET = 1
+LAST_WEEK = {"start_date": (datetime.utcnow() - timedelta(days=7)).isoformat(), "end_date": datetime.utcnow().isoformat()}
+
+
+def query_count(response) -> int:
+    return int(re.search(r'desc="(\d+) queries"', response.headers["Server-Timing"]).group(1))
+
+
+def test_ticket_pages_cost_a_constant_number_of_queries(client, admin_headers, tickets):
+    seen, cursor, pages = [], None, 0
+    while True:
+        params = {"page_size": 7, "sort_by": "entry_time_desc"}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/admin/tickets", params=params, headers=admin_headers)
+        assert response.status_code == 200, response.text
+        pages += 1
+        assert query_count(response) <= TICKET_PAGE_QUERY_BUDGET, f"page {pages}"
+        seen += [ticket["ticket_id"] for ticket in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert pages > 1
+    assert len(seen) == len(set(seen)), "a page repeated tickets from an earlier page"
+    with main.SessionLocal() as db:
+        assert len(seen) == db.query(main.Ticket).count()
+
+
+@pytest.mark.parametrize("path, params, budget", [
+    ("/admin/dashboard/summary", {}, 1),
+    ("/admin/dashboard/trends", {}, 4),
+    ("/admin/parking-lots/1/map", {}, 2),
+    ("/admin/tickets", {"status": "active", "page_size": 500}, TICKET_PAGE_QUERY_BUDGET),
+    ("/admin/vehicles/search", {"q": "KA00AB"}, 1),
+    ("/admin/events/snapshot", {}, 1),
+    ("/admin/reports/revenue", LAST_WEEK, 3),
+    ("/admin/reports/occupancy", LAST_WEEK, 5),
+])
+def test_admin_reads_stay_within_query_budget(client, admin_headers, tickets, path, params, budget):
+    response = client.get(path, params=params, headers=admin_headers)
+    assert response.status_code == 200, response.text
+    assert query_count(response) <= budget
+
+
+def test_exit_details_cost_a_constant_number_of_queries(client, tickets):
+    response = client.get(f"/exit/details/{tickets[0]}")
+    assert response.status_code == 200, response.text
+    assert query_count(response) <= 2
+
+
+def test_failed_statements_leave_no_timer_on_the_connection(client):
+    with main.engine.connect() as connection:
+        with pytest.raises(main.IntegrityError):
+            connection.execute(main.insert(main.SystemUser), {"username": "admin", "password_hash": "x", "role": "Operator"})
+        assert not connection.info.get("query_started")
@@ -0,0 +1,83 @@
+"""
+Every statement the gate and admin routes run must be served by an index. The statements are
+captured from real requests, so a router query that changes is checked as it now reads.
+"""
+import re
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import main
+from conftest import issue_ticket, next_plate
+
+# Tables that grow with traffic; the lot and counter tables stay a few rows long
+GROWING_TABLES = {"Ticket", "Payment", "Vehicle", "ParkingSpot", "IdempotencyKey", "RevenueRollup", "OccupancyRollup"}
+
+
+def full_scans(connection, statement, parameters):
+    """Growing tables the statement reads without an index."""
+    if connection.dialect.name == "sqlite":
+        plan = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        scanned = [re.match(r"SCAN (\w+)", step) for step in plan if " INDEX " not in step]
+    else:
+        plan = [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+        scanned = [re.search(r'Seq Scan on "?(\w+)', step) for step in plan]
+    # Aliases such as Ticket_1 name the table they stand for
+    return {re.sub(r"_\d+$", "", match.group(1)) for match in scanned if match} & GROWING_TABLES
+
+
+@pytest.fixture
+def captured_statements():
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE")):
+            statements.append((statement, parameters))
+
+    event.listen(main.engine, "before_cursor_execute", capture)
+    yield statements
+    event.remove(main.engine, "before_cursor_execute", capture)
+
+
+def hot_requests(client, tickets):
+    now = datetime.utcnow()
+    window = {"start_date": (now - timedelta(days=7)).isoformat(), "end_date": now.isoformat()}
+    leaving = issue_ticket(client)
+    fee = client.get(f"/exit/details/{leaving}").json()["calculated_fee"]
+    gate_entry = {
+        "idempotency_key": f"plans-{leaving}", "type": "entry", "occurred_at": now.isoformat(),
+        "vehicle_number": next_plate(), "vehicle_type": "Compact",
+    }
+    return [
+        ("POST", "/entry/ticket", {"json": {"vehicle_number": next_plate(), "vehicle_type": "Compact"}}),
+        ("GET", f"/exit/details/{tickets[0]}", {}),
+        ("POST", "/exit/payment", {"json": {"ticket_id": leaving, "amount_paid": fee, "payment_method": "Card"}}),
+        ("POST", "/gate/events", {"json": {"events": [gate_entry]}}),
+        ("GET", "/admin/dashboard/summary", {}),
+        ("GET", "/admin/dashboard/trends", {}),
+        ("GET", "/admin/parking-lots/1/map", {}),
+        ("GET", "/admin/tickets", {"params": {"status": "active", "sort_by": "entry_time_asc"}}),
+        ("GET", "/admin/tickets", {"params": {"vehicle_number": "KA00"}}),
+        ("GET", "/admin/vehicles/search", {"params": {"q": "KA00AB"}}),
+        ("GET", "/admin/reports/revenue", {"params": window}),
+        ("GET", "/admin/reports/occupancy", {"params": window}),
+        ("GET", "/admin/events/snapshot", {}),
+    ]
+
+
+def test_hot_routes_use_indexes(client, admin_headers, tickets, captured_statements):
+    offenders = []
+    for method, path, options in hot_requests(client, tickets):
+        captured_statements.clear()
+        response = client.request(method, path, headers=admin_headers, **options)
+        assert response.status_code < 400, f"{method} {path}: {response.text}"
+        with main.engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                # Test tables are tiny, which makes a sequential scan look cheap; ask whether an index exists at all
+                connection.exec_driver_sql("SET enable_seqscan = off")
+            for statement, parameters in captured_statements:
+                tables = full_scans(connection, statement, parameters)
+                if tables:
+                    offenders.append(f"{method} {path} scans {', '.join(sorted(tables))}: {' '.join(statement.split())}")
+    assert not offenders, "\n".join(offenders)
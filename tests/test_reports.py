@@ -0,0 +1,17 @@
+"""
+Limits of the admin reports.
+"""
+from datetime import datetime, timedelta
+
+import main
+
+
+def test_occupancy_report_rejects_ranges_longer_than_the_sweep_allows(client, admin_headers):
+    end = datetime.utcnow()
+    too_long = {"start_date": (end - timedelta(days=main.OCCUPANCY_SWEEP_MAX_DAYS, hours=1)).isoformat(), "end_date": end.isoformat()}
+    response = client.get("/admin/reports/occupancy", params=too_long, headers=admin_headers)
+    assert response.status_code == 400, response.text
+
+    longest = {"start_date": (end - timedelta(days=main.OCCUPANCY_SWEEP_MAX_DAYS)).isoformat(), "end_date": end.isoformat()}
+    response = client.get("/admin/reports/occupancy", params=longest, headers=admin_headers)
+    assert response.status_code == 200, response.text
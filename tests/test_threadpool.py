@@ -0,0 +1,22 @@
+"""
+Sync endpoints share the threadpool with the connections they hold; a burst larger than the
+pool must queue, not leave every thread waiting on connections that cannot be given back.
+"""
+import asyncio
+
+import httpx
+
+import main
+
+BURST = 4 * (main.DB_POOL_SIZE + main.DB_MAX_OVERFLOW)
+
+
+def test_burst_beyond_the_pool_completes(client, tickets):
+    async def burst():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as burst_client:
+            return await asyncio.gather(*(burst_client.get(f"/exit/details/{tickets[n % len(tickets)]}") for n in range(BURST)))
+
+    # Well inside DB_POOL_TIMEOUT, which is how long a starved request would wait before failing
+    responses = asyncio.run(asyncio.wait_for(burst(), 20))
+    assert [response.status_code for response in responses] == [200] * BURST